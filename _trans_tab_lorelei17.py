@@ -6,9 +6,10 @@ import itertools
 import logging
 import argparse
 import ujson as json
-import urllib
-from urllib.request import urlopen
-import functools
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger()
@@ -22,22 +23,27 @@ API_DATASET = {
 API = 'http://blender03.cs.rpi.edu:8086/resource/lexicon?' \
       'dataset=%s&morph=true&query=%s'
 
-pdes_il6 = '/nas/data/m1/panx2/workspace/lorelei/data/dict/il6/designator.gaz'
-designators_il6 = set()
-designators_eng = set()
-with open(pdes_il6, 'r') as f:
-    for line in f:
-        tmp = line.rstrip('\n').split('\t')
-        if tmp[1] == 'GPE':
-            designators_il6.add(tmp[0])
-            designators_eng.add(tmp[3].lower())
-
-
-@functools.lru_cache(maxsize=None)
-def trans_api(query, lang):
-    query = query.replace('@', '').replace('#', '')
-    url = API % (API_DATASET[lang], urllib.parse.quote_plus(query))
-    res = json.loads(urlopen(url).read().decode('utf-8'))
+PDES_IL6 = '/nas/data/m1/panx2/workspace/lorelei/data/dict/il6/designator.gaz'
+
+
+def read_designators(pdes):
+    # Returns (il6 designators, their english glosses) of GPE entries
+    designators_il6 = set()
+    designators_eng = set()
+    with open(pdes, 'r') as f:
+        for line in f:
+            tmp = line.rstrip('\n').split('\t')
+            if tmp[1] == 'GPE':
+                designators_il6.add(tmp[0])
+                designators_eng.add(tmp[3].lower())
+    return designators_il6, designators_eng
+
+
+def normalize(query):
+    return query.replace('@', '').replace('#', '')
+
+
+def rank_trans(res):
     trans = defaultdict(int)
     for i in res:
         if '_GIZA' in i['lexicon']:
@@ -57,37 +63,166 @@ def trans_api(query, lang):
                                  key=lambda x: x[1], reverse=True)]
 
 
-def main(tab, lang, outpath=None):
+class LexiconClient(object):
+    # Batched lexicon lookups. Distinct queries are fetched concurrently by
+    # a bounded thread pool that lives as long as the client; each of its
+    # threads keeps one keep-alive connection per host across lookups.
+    # close() (or leaving a with block) stops the pool and closes every
+    # connection. Raw responses are appended to an on-disk cache (one
+    # "lang\tquery\tjson" line each), so reruns only fetch new queries.
+    def __init__(self, api=API, workers=8, timeout=30, retries=2,
+                 pcache=None):
+        self.api = api
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.pcache = pcache
+        self.cache = {}
+        self.fetched = 0
+        self._local = threading.local()
+        self._pool = None
+        # every connection opened by any thread, for close()
+        self._conns = []
+        self._lock = threading.Lock()
+        if pcache and os.path.exists(pcache):
+            with open(pcache, 'r') as f:
+                for line in f:
+                    lang, query, res = line.rstrip('\n').split('\t', 2)
+                    self.cache[(lang, query)] = json.loads(res)
+            logger.info('loaded %s cached lookups from %s' %
+                        (len(self.cache), pcache))
+
+    def _connection(self, scheme, netloc):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc,
+                                                   timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc,
+                                                  timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            del self._conns[:]
+        # threads of a later pool start with no connections
+        self._local = threading.local()
+
+    def fetch(self, query, lang):
+        url = urllib.parse.urlsplit(
+            self.api % (API_DATASET[lang], urllib.parse.quote_plus(query)))
+        path = url.path
+        if url.query:
+            path += '?' + url.query
+        for attempt in range(self.retries + 1):
+            conn = self._connection(url.scheme, url.netloc)
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.HTTPException, OSError):
+                # stale keep-alive connection or timeout: reconnect
+                conn.close()
+                if attempt == self.retries:
+                    raise
+                continue
+            if resp.status != 200:
+                raise IOError('lexicon api returned %s for %s' %
+                              (resp.status, query))
+            return json.loads(body.decode('utf-8'))
+
+    def lookup(self, queries, lang):
+        # Returns query -> ranked translations for every query
+        queries = set(normalize(i) for i in queries)
+        todo = [i for i in queries if (lang, i) not in self.cache]
+        if todo:
+            logger.info('fetching %s of %s queries' %
+                        (len(todo), len(queries)))
+            fw = open(self.pcache, 'a') if self.pcache else None
+            try:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.workers)
+                results = self._pool.map(lambda x: self.fetch(x, lang), todo)
+                for query, res in zip(todo, results):
+                    self.cache[(lang, query)] = res
+                    self.fetched += 1
+                    if fw:
+                        fw.write('%s\t%s\t%s\n' %
+                                 (lang, query, json.dumps(res)))
+            finally:
+                if fw:
+                    fw.close()
+        return {i: rank_trans(self.cache[(lang, i)]) for i in queries}
+
+
+def main(tab, lang, outpath=None, client=None, pdes=PDES_IL6):
+    if client is None:
+        with LexiconClient() as client:
+            return main(tab, lang, outpath=outpath, client=client,
+                        pdes=pdes)
+    designators_il6 = set()
+    if lang == 'il6':
+        designators_il6, designators_eng = read_designators(pdes)
+
     count = {
         'tol': 0,
         'trans': 0
     }
 
-    for i, line in enumerate(tab):
-        if not line:
+    rows = [line.rstrip('\n').split('\t') if line else None for line in tab]
+    mentions = [tmp[2] for tmp in rows if tmp]
+    trans = client.lookup(mentions, lang)
+
+    # retry untranslated mentions without their leading designator
+    stripped = {}
+    for mention in mentions:
+        if trans[normalize(mention)]:
+            continue
+        toks = mention.split(' ')
+        if toks[0] in designators_il6:
+            stripped[mention] = ' '.join(toks[1:])
+    if stripped:
+        trans.update(client.lookup(stripped.values(), lang))
+
+    for i, tmp in enumerate(rows):
+        if not tmp:
             continue
-        tmp = line.rstrip('\n').split('\t')
         mention = tmp[2]
-        trans = trans_api(mention, lang)
-
-        if not trans and lang == 'il6':
-            toks = tmp[2].split(' ')
-            if toks[0] in designators_il6:
-                mention = ' '.join(toks[1:])
-                trans = trans_api(mention, lang)
+        res = trans[normalize(mention)]
+        if not res and mention in stripped:
+            res = trans[normalize(stripped[mention])]
 
-        if not trans:
-            trans = 'NULL'
+        if not res:
+            res = 'NULL'
         else:
-            trans = '|'.join(trans)
+            res = '|'.join(res)
             count['trans'] += 1
         count['tol'] += 1
 
-        tmp.append(trans)
+        tmp.append(res)
         tab[i] = '\t'.join(tmp)
 
     logger.info('# of translated mentions: %s' % count['trans'])
     logger.info('# of total mentions: %s' % count['tol'])
+    logger.info('# of lexicon api requests: %s' % client.fetched)
 
     if outpath:
         with open(outpath, 'w') as fw:
@@ -101,6 +236,18 @@ if __name__ == '__main__':
     parser.add_argument('ptab', type=str, help='path to tab')
     parser.add_argument('outpath', type=str, help='output path')
     parser.add_argument('lang', type=str, help='lang')
+    parser.add_argument('--api', type=str, default=API,
+                        help='lexicon api url template (dataset, query)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='max concurrent api requests')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='api request timeout in seconds')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='path to persistent lookup cache')
+    parser.add_argument('--pdes', type=str, default=PDES_IL6,
+                        help='path to il6 designators')
     args = parser.parse_args()
     tab = open(args.ptab, 'r').read().split('\n')
-    main(tab, args.lang, args.outpath)
+    with LexiconClient(api=args.api, workers=args.workers,
+                       timeout=args.timeout, pcache=args.cache) as client:
+        main(tab, args.lang, args.outpath, client=client, pdes=args.pdes)
@@ -2,182 +2,111 @@ import re
 import sys
 import logging
 import argparse
-import string
-import itertools
 from collections import defaultdict
 
 import util
-from util import TacTab
+import cache
+import interval
+import columnar
+import decisions
+import instrument
+import candidates
+from fuzzy import FuzzyIndex
 
 
 logger = logging.getLogger()
 logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
 logging.root.setLevel(level=logging.INFO)
 
+# Languages written without spaces between words, where gazetteers are
+# matched on characters instead of BIO tokens by default
+CHAR_LANGS = ['zh', 'th', 'my']
+MATCHERS = ['token', 'char']
+
+
+def gaz_matcher(lang=None, matcher=None):
+    # The gazetteer matcher asked for, else the default of the language
+    if matcher:
+        return matcher
+    return 'char' if lang in CHAR_LANGS else 'token'
+
 
 def add_poster_author(bio, psm):
-    res = []
-    count = 0
-    for docid in bio:
-        if 'DF_' not in docid:
-            continue
-        for tok, beg, end in bio[docid]:
-            if tok in psm[docid]:
-                offset = '%s:%s-%s' % (docid, beg, end)
-                qid = 'DFPA_' + '{number:0{width}d}'.format(width=7,
-                                                            number=count)
-                kbid = 'NIL'
-                etype = 'PER'
-                mtype = 'NAM'
-                conf = '1.0'
-                res.append(TacTab('DF_poster_author', qid, tok,
-                                  offset, kbid, etype, mtype, conf))
-                count += 1
-    return res
+    return candidates.scan(
+        bio, [candidates.PosterAuthorMatcher(psm)])['poster_author']
 
 
-def add_gazetteer(bio, gaz, gaz_tree, des=None, mtype='NAM'):
-    res_trusted = []
-    res_untrusted = []
-    count = 0
-    for docid in bio:
-        for i, (tok, beg, end) in enumerate(bio[docid]):
-            if tok in gaz_tree:
-                tree = gaz_tree[tok]
-                mention = [tok]
-                offset = [(beg, end)]
-                for j, (next_tok, next_beg, next_end) in \
-                    enumerate(bio[docid][i+1:]):
-                    if next_tok in tree:
-                        tree = tree[next_tok]
-                        mention.append(next_tok)
-                        offset.append((next_beg, next_end))
-                    else:
-                        break
-                mention = ' '.join(mention)
-                if mention in gaz:
-                    etype, op, additional_info = gaz[mention]
-
-                    if des:
-                        prev_tok, prev_beg, prev_end = bio[docid][i-1]
-                        if prev_tok in des:
-                            etype = des[prev_tok][0]
-                            mention = '%s %s' % (prev_tok, mention)
-                            offset = [(prev_beg, prev_end)] + offset
-
-                    offset = '%s:%s-%s' % (docid, offset[0][0], offset[-1][1])
-                    qid = 'GAZ_' + '{number:0{width}d}'.format(width=7,
-                                                               number=count)
-                    kbid = 'NIL'
-                    mtype = mtype
-                    conf = '1.0'
-                    trans = additional_info
-                    tt = TacTab('Gazetterr', qid, mention, offset, kbid,
-                                etype, mtype, conf, trans=trans)
-                    if op == 'p':
-                        res_trusted.append(tt)
-                    elif op == 'p2':
-                        res_untrusted.append(tt)
-                    else:
-                        logger.error('unrecognized op: %s' % op)
-                        exit()
-                    count += 1
-    return res_trusted, res_untrusted
-
-
-def add_sn(bio, gaz=None):
-    res = []
-    count = 0
-    for docid in bio:
-        if 'SN_' not in docid:
-            continue
-        for i, (tok, beg, end) in enumerate(bio[docid]):
-            if tok.startswith('#'):
-                name = tok[1:]
-                if name.isdigit():
-                    continue
-                translation = str.maketrans('', '', string.punctuation);
-                if name.translate(translation) == '':
-                    continue
-                if '#' in name or '@' in name:
-                    continue
-                mention = tok
-                offset = '%s:%s-%s' % (docid, beg, end)
-                qid = 'SNHASH_' + '{number:0{width}d}'.format(width=7,
-                                                              number=count)
-                kbid = 'NIL'
-                additional_info = None
-                if gaz and mention in gaz:
-                    etype, op, additional_info = gaz[mention]
-                    if etype == '-':
-                        continue
-                else:
-                    etype = 'GPE'
-                mtype = 'NAM'
-                conf = '1.0'
-                res.append(TacTab('SN_HASH', qid, mention, offset, kbid,
-                                  etype, mtype, conf, trans=additional_info))
-                count += 1
-
-            if tok.startswith('@'):
-                name = tok[1:]
-                if name.isdigit():
-                    continue
-                translation = str.maketrans('', '', string.punctuation);
-                if name.translate(translation) == '':
-                    continue
-                if '#' in name or '@' in name:
-                    continue
-                mention = tok
-                offset = '%s:%s-%s' % (docid, beg, end)
-                qid = 'SNAT_' + '{number:0{width}d}'.format(width=7,
-                                                            number=count)
-                kbid = 'NIL'
-                additional_info = None
-                if gaz and mention in gaz:
-                    etype, op, additional_info = gaz[mention]
-                    if etype == '-':
-                        continue
-                else:
-                    etype = 'PER'
-                mtype = 'NAM'
-                conf = '1.0'
-                res.append(TacTab('SN_AT', qid, mention, offset, kbid,
-                                  etype, mtype, conf, trans=additional_info))
-                count += 1
-    return res
+def add_gazetteer(bio, gaz, gaz_tree, des=None, mtype='NAM', vocab=None,
+                  fuzzy=None):
+    # Returns (trusted, untrusted) names, see candidates.GazetteerMatcher
+    res = candidates.scan(bio, [candidates.GazetteerMatcher(
+        gaz, gaz_tree, des=des, mtype=mtype, fuzzy=fuzzy,
+        lower=vocab is not None)], vocab=vocab)
+    return res['p'], res['p2']
+
+
+def add_gazetteer_chars(bio, gaz, gaz_chars, des=None, mtype='NAM',
+                        vocab=None):
+    # add_gazetteer on characters, see candidates.CharGazetteerMatcher
+    res = candidates.scan(bio, [candidates.CharGazetteerMatcher(
+        gaz, gaz_chars, des=des, mtype=mtype)], vocab=vocab)
+    return res['p'], res['p2']
+
+
+def add_sn(bio, gaz=None, vocab=None, fuzzy=None):
+    return candidates.scan(bio, [candidates.SNMatcher(gaz, fuzzy=fuzzy)],
+                           vocab=vocab)['sn']
 
 
-def check_conflicts_single_tab(tab):
-    new_tab = []
+def iter_overlap_groups(tab, columns=False):
+    if columns:
+        return columnar.overlap_groups(tab)
     tab_doc = util.get_tab_in_doc_level(tab)
-    overlapped_pair = []
-    for docid in tab_doc:
-        for i, j in itertools.combinations(tab_doc[docid], 2):
-            if j.beg <= i.beg <= j.end or j.beg <= i.end <= j.end:
-                overlapped_pair.append((i, j))
-
-    dropped_tab = set()
-    for i, j in overlapped_pair:
-        # Select longer names
-        if len(i.mention.split(' ')) < len(j.mention.split(' ')):
-            dropped_tab.add(i)
-        else:
-            dropped_tab.add(j)
+    return (group for docid in tab_doc
+            for group in interval.overlap_groups(tab_doc[docid]))
+
+
+def name_length(mention, by_chars=False):
+    # Names are longer by tokens, or by characters of the span for names
+    # matched on characters, which have no spaces to count
+    if by_chars:
+        return mention.end - mention.beg + 1
+    return len(mention.mention.split(' '))
+
+
+def is_shorter(mention, other, by_chars=False):
+    # must_longer test of check_conflicts_duo_tab
+    if by_chars:
+        return mention.end - mention.beg < other.end - other.beg
+    return len(mention.mention) < len(other.mention)
 
-    for i in tab:
-        if i not in dropped_tab:
-            new_tab.append(i)
+
+def check_conflicts_single_tab(tab, columns=False, by_chars=False):
+    rank = {id(i): n for n, i in enumerate(tab)}
+    n_groups = 0
+    kept_tab = set()
+    for group in iter_overlap_groups(tab, columns=columns):
+        if len(group) == 1:
+            kept_tab.add(group[0])
+            continue
+        # Select longer names, earlier names first on ties
+        n_groups += 1
+        kept_tab.update(interval.select_non_overlapping(
+            group, key=lambda x: (-name_length(x, by_chars), rank[id(x)])))
+
+    new_tab = [i for i in tab if i in kept_tab]
 
     logger.info('  # of names in the tab: %s' % len(tab))
     logger.info('  checking conflicted names...')
+    logger.info('  %s overlapped groups resolved' % n_groups)
     logger.info('  %s overlapped matched names, select longer names' \
                 % (len(tab) - len(new_tab)))
     return new_tab
 
 
 def check_conflicts_duo_tab(tab, tab_to_add, trust_new=False, must_longer=False,
-                            verbose=False, verbose_thres=0):
+                            verbose=False, verbose_thres=0, columns=False,
+                            stage='duo_tab', by_chars=False):
     duplicate_tab = []
     overlapped_tab = []
     non_overlapped_tab = []
@@ -185,55 +114,70 @@ def check_conflicts_duo_tab(tab, tab_to_add, trust_new=False, must_longer=False,
     logger.info('  # of names in the original tab: %s' % len(tab))
     logger.info('  # of names in the addtional tab: %s' % len(tab_to_add))
     logger.info('  checking conflicted names...')
-    tab_doc = util.get_tab_in_doc_level(tab)
-    for i in tab_to_add:
-        overlapped = False
-        for j in tab_doc[i.docid]:
-            # if (i.beg, i.end) == (j.beg, j.end) and i.etype == j.etype:
-            if (i.beg, i.end) == (j.beg, j.end):
-                duplicate_tab.append((i, j))
-                overlapped = True
-                break
-            if max(i.beg, j.beg) < min(i.end, j.end):
-                overlapped_tab.append((i, j))
-                overlapped = True
-        if not overlapped:
-            non_overlapped_tab.append(i)
+    if isinstance(tab, interval.MentionIndex):
+        index = tab
+    else:
+        index = interval.MentionIndex(tab)
+    if columns:
+        duplicate_tab, overlapped_tab, non_overlapped_tab = \
+            columnar.duo_overlaps(index, tab_to_add)
+    else:
+        for i in tab_to_add:
+            overlapped = False
+            for j in index.query(i.docid, i.beg, i.end):
+                # if (i.beg, i.end) == (j.beg, j.end) and i.etype == j.etype:
+                if (i.beg, i.end) == (j.beg, j.end):
+                    duplicate_tab.append((i, j))
+                    overlapped = True
+                    break
+                if max(i.beg, j.beg) < min(i.end, j.end):
+                    overlapped_tab.append((i, j))
+                    overlapped = True
+            if not overlapped:
+                non_overlapped_tab.append(i)
 
     logger.info('  # of duplicate names: %s' % (len(duplicate_tab)))
     logger.info('  # of overlapped names: %s' % (len(overlapped_tab)))
+    log = decisions.active()
+    if log:
+        for i, j in duplicate_tab:
+            log.record(stage, 'duplicate', i, old=j.etype, new=i.etype)
+        for i in non_overlapped_tab:
+            log.record(stage, 'added', i, new=i.etype)
     if trust_new:
         logger.info('TRUST NEW NAMES')
-        new_main_tab = []
-
         to_add = []
         to_remove = []
         for i, j in overlapped_tab:
-            if must_longer and len(i.mention) < len(j.mention):
+            if must_longer and is_shorter(i, j, by_chars):
                 continue
             to_add.append(i)
-            to_remove.append(j.offset)
-        to_add = list(set(to_add))
+            to_remove.append(j)
+        to_add = list(dict.fromkeys(to_add))
+        if log:
+            for i, j in overlapped_tab:
+                if must_longer and is_shorter(i, j, by_chars):
+                    log.record(stage, 'kept_longer', i, old=j.etype,
+                               new=i.etype)
+                    continue
+                log.record(stage, 'replaced', j, old=j.etype, new=i.etype)
         if verbose:
             logger.info('verbose...')
             overlapped_tab_count = defaultdict(int)
             for i, j in overlapped_tab:
-                if must_longer and len(i.mention) < len(j.mention):
+                if must_longer and is_shorter(i, j, by_chars):
                     continue
-                m = "'%s' %s -> '%s' %s" % (j.mention, j.etype,
-                                            i.mention, i.etype)
-                overlapped_tab_count[m] += 1
+                overlapped_tab_count[(j.mention, j.etype,
+                                      i.mention, i.etype)] += 1
             for m, c in sorted(overlapped_tab_count.items(),
                                key=lambda x: x[1], reverse=True):
-                msg = '    %s | %s' % (m, c)
-                logger.info(msg)
-        for i in tab:
-            if i.offset not in to_remove:
-                new_main_tab.append(i)
+                logger.info("    '%s' %s -> '%s' %s | %s" % (m + (c,)))
+        for j in to_remove:
+            index.remove_offset(j)
         logger.info('  # of names revised: %s' % (len(to_add)))
 
-        new_main_tab += to_add
-        new_main_tab += non_overlapped_tab
+        index.extend(to_add)
+        index.extend(non_overlapped_tab)
         if verbose:
             logger.info('verbose...')
             for i in to_add:
@@ -246,10 +190,12 @@ def check_conflicts_duo_tab(tab, tab_to_add, trust_new=False, must_longer=False,
                 logger.info('  %s | %s | %s | %s' % (i[0], i[1], i[2], c))
         logger.info('  # of names added: %s' % (len(non_overlapped_tab)))
         logger.info('  # of names revised: %s' % (len(to_add)))
-        return new_main_tab
     else:
         logger.info('TRUST ORIGINAL NAMES')
-        tab += non_overlapped_tab
+        if log:
+            for i, j in overlapped_tab:
+                log.record(stage, 'overlapped', i, old=j.etype, new=i.etype)
+        index.extend(non_overlapped_tab)
         if verbose:
             logger.info('verbose...')
             for i in non_overlapped_tab:
@@ -259,18 +205,24 @@ def check_conflicts_duo_tab(tab, tab_to_add, trust_new=False, must_longer=False,
                     continue
                 logger.info('  %s | %s | %s | %s' % (i[0], i[1], i[2], c))
         logger.info('  # of names added: %s' % len(non_overlapped_tab))
-        return tab
+    if index is tab:
+        return index
+    return list(index)
 
 
-def revise_etype(tab, gaz, verbose=False):
+def revise_etype(tab, gaz, verbose=False, stage='revise_etype', vocab=None):
     tol = 0
     count = defaultdict(int)
+    log = decisions.active()
     for i in tab:
-        if i.mention in gaz and i.etype != gaz[i.mention][0]:
-            if gaz[i.mention][0] == '-':
+        key = i.mention if vocab is None else vocab.key(i.mention)
+        if key in gaz and i.etype != gaz[key][0]:
+            if gaz[key][0] == '-':
                 continue
-            count[(i.mention, i.etype, gaz[i.mention][0])] += 1
-            i.etype = gaz[i.mention][0]
+            count[(i.mention, i.etype, gaz[key][0])] += 1
+            if log:
+                log.record(stage, 'gaz', i, old=i.etype, new=gaz[key][0])
+            i.etype = gaz[key][0]
             tol += 1
     logger.info('# of revised etypes: %s' % tol)
     if verbose:
@@ -279,56 +231,162 @@ def revise_etype(tab, gaz, verbose=False):
             logger.info('  %s | %s -> %s | %s' % (i[0], i[1], i[2], c))
 
 
+def iter_bio(bio):
+    # A path is streamed from disk, a read_bio dict is used as it is
+    if isinstance(bio, str):
+        return util.iter_bio(bio, compact=True)
+    return util.iter_docs(bio)
+
+
+def load_resources(lower=False, ppsm=None, pgaz=None, psn=None, pdes=None,
+                   cache_dir=None, compact=False, fuzzy=0, matcher='token'):
+    # fuzzy > 0 also indexes the gazetteer and SN tokens for matches within
+    # that edit distance. With the 'char' matcher the gazetteer is compiled
+    # into a character automaton instead, which only matches exactly, so
+    # only SN names are then matched approximately.
+    res = {
+        'psm': None,
+        'gaz': None,
+        'gaz_tree': None,
+        'des': None,
+        'sn': None,
+        'vocab': util.new_vocab(lower),
+        'gaz_fuzzy': None,
+        'sn_fuzzy': None,
+        'gaz_chars': None,
+    }
+    with instrument.stage('load.resources'):
+        if ppsm:
+            res['psm'] = util.read_psm(ppsm)
+        if pgaz:
+            logger.info('loading gazetterrs...')
+            if pdes:
+                res['des'], des_tree = cache.read_gaz(
+                    pdes, lower=lower, cache_dir=cache_dir, compact=compact)
+            res['gaz'], res['gaz_tree'] = cache.read_gaz(
+                pgaz, lower=lower, cache_dir=cache_dir, compact=compact)
+            if fuzzy and matcher == 'char':
+                logger.warning('the char matcher matches gazetteers '
+                               'exactly, --fuzzy only applies to SN names')
+            elif fuzzy:
+                res['gaz_fuzzy'] = FuzzyIndex(res['gaz'], k=fuzzy)
+            if matcher == 'char':
+                res['gaz_chars'] = cache.read_gaz_chars(
+                    pgaz, lower=lower, cache_dir=cache_dir)
+        if psn:
+            res['sn'], sn_tree = cache.read_gaz(
+                psn, lower=lower, cache_dir=cache_dir, compact=compact)
+            if fuzzy:
+                res['sn_fuzzy'] = FuzzyIndex(res['sn'], k=fuzzy)
+    return res
+
+
+def find_candidates(pbio, resources, sn=True, mtype='NAM'):
+    # One pass of every candidate generator over the BIO file, streamed one
+    # document at a time so it never has to fit in memory. Candidates do
+    # not depend on the tab, so they are all found before the merges.
+    chain = ['poster_author', 'gazetteer'] + (['sn'] if sn else [])
+    matchers = candidates.build_matchers(resources, chain=chain, mtype=mtype)
+    with instrument.stage('add.candidates') as st:
+        res = candidates.scan(st.count_docs(iter_bio(pbio)), matchers,
+                              vocab=resources['vocab'])
+        st.count(mentions=sum(len(i) for i in res.values()))
+    return res
+
+
+def copy_candidates(cands):
+    # The merges and revise_etype() change candidates in place, so each
+    # tab merged with the same candidates needs its own copies
+    return dict((k, [i.copy() for i in v]) for k, v in cands.items())
+
+
 def process(tab, pbio, outpath=None, sn=True, lower=False,
-            ppsm=None, pgaz=None, psn=None, pdes=None, mtype='NAM'):
-    bio = util.read_bio(pbio)
+            ppsm=None, pgaz=None, psn=None, pdes=None, mtype='NAM',
+            resources=None, cache_dir=None, columns=False, compact=False,
+            fuzzy=0, matcher='token', cands=None):
+    # cands, when given, are the find_candidates() of pbio, which is then
+    # not read
+    if resources is None:
+        resources = load_resources(lower=lower, ppsm=ppsm, pgaz=pgaz,
+                                   psn=psn, pdes=pdes, cache_dir=cache_dir,
+                                   compact=compact, fuzzy=fuzzy,
+                                   matcher=matcher)
     logger.info('\n------ ADDING NAMES ------')
+    if cands is None:
+        cands = find_candidates(pbio, resources, sn=sn, mtype=mtype)
 
-    if ppsm:
+    # Every merge below updates this index in place
+    if not isinstance(tab, interval.MentionIndex):
+        tab = interval.MentionIndex(tab)
+
+    if resources['psm'] is not None:
         logger.info('\n--- ADDING df poster authors ---')
-        psm = util.read_psm(ppsm)
-        tab_to_add = add_poster_author(bio, psm)
+        tab_to_add = cands['poster_author']
         logger.info('# of df poster authors found: %s' % (len(tab_to_add)))
-        tab = check_conflicts_duo_tab(tab, tab_to_add, trust_new=True)
+        with instrument.stage('check.duo_tab.poster_author') as st:
+            st.count_tab(tab_to_add)
+            tab = check_conflicts_duo_tab(tab, tab_to_add, trust_new=True,
+                                          columns=columns,
+                                          stage='duo_tab.poster_author')
 
-    if pgaz:
+    if resources['gaz'] is not None:
         logger.info('\n--- ADDING gazetterrs ---')
-        if pdes:
-            des, des_tree = util.read_gaz(pdes, lower=lower)
-        else:
-            des = None
-        gaz, gaz_tree = util.read_gaz(pgaz, lower=lower)
-        logger.info('loading gazetterrs...')
-        tab_to_add_p, tab_to_add_p2 = add_gazetteer(bio, gaz, gaz_tree, des=des,
-                                                    mtype=mtype)
+        gaz = resources['gaz']
+        # names matched on characters are compared by their spans
+        by_chars = resources['gaz_chars'] is not None
+        tab_to_add_p = cands['p']
+        tab_to_add_p2 = cands['p2']
         logger.info('checking trusted (p) names...')
-        tab_to_add_p = check_conflicts_single_tab(tab_to_add_p)
+        with instrument.stage('check.single_tab.p') as st:
+            st.count_tab(tab_to_add_p)
+            tab_to_add_p = check_conflicts_single_tab(tab_to_add_p,
+                                                      columns=columns,
+                                                      by_chars=by_chars)
         logger.info('checking untrusted (p2) names...')
-        tab_to_add_p2 = check_conflicts_single_tab(tab_to_add_p2)
+        with instrument.stage('check.single_tab.p2') as st:
+            st.count_tab(tab_to_add_p2)
+            tab_to_add_p2 = check_conflicts_single_tab(tab_to_add_p2,
+                                                       columns=columns,
+                                                       by_chars=by_chars)
         logger.info('-- trusted (p) names found: %s' % (len(tab_to_add_p)))
-        tab = check_conflicts_duo_tab(tab, tab_to_add_p, trust_new=True,
-                                      verbose=True)
+        with instrument.stage('check.duo_tab.p') as st:
+            st.count_tab(tab_to_add_p)
+            tab = check_conflicts_duo_tab(tab, tab_to_add_p, trust_new=True,
+                                          verbose=True, columns=columns,
+                                          stage='duo_tab.p',
+                                          by_chars=by_chars)
         logger.info('-- untrusted (p2) names found: %s' % (len(tab_to_add_p2)))
-        tab = check_conflicts_duo_tab(tab, tab_to_add_p2, trust_new=False,
-                                      verbose=True)
+        with instrument.stage('check.duo_tab.p2') as st:
+            st.count_tab(tab_to_add_p2)
+            tab = check_conflicts_duo_tab(tab, tab_to_add_p2, trust_new=False,
+                                          verbose=True, columns=columns,
+                                          stage='duo_tab.p2',
+                                          by_chars=by_chars)
 
         logger.info('\n--- REVISING entity types ---')
-        revise_etype(tab, gaz, verbose=True)
+        with instrument.stage('revise_etype.gaz') as st:
+            st.count(mentions=len(tab))
+            revise_etype(tab, gaz, verbose=True, stage='revise_etype.gaz',
+                         vocab=resources['vocab'])
 
     if sn:
         logger.info('\n--- ADDING social network names ---')
-        if psn:
-            gaz, gaz_tree = util.read_gaz(psn, lower=lower)
-        else:
-            gaz = None
-        tab_to_add = add_sn(bio, gaz=gaz)
+        gaz = resources['sn']
+        tab_to_add = cands['sn']
         logger.info('# of SN names found: %s' % (len(tab_to_add)))
-        tab = check_conflicts_duo_tab(tab, tab_to_add, trust_new=True,
-                                      verbose=True, verbose_thres=5)
+        with instrument.stage('check.duo_tab.sn') as st:
+            st.count_tab(tab_to_add)
+            tab = check_conflicts_duo_tab(tab, tab_to_add, trust_new=True,
+                                          verbose=True, verbose_thres=5,
+                                          columns=columns, stage='duo_tab.sn')
 
         logger.info('\n--- REVISING entity types ---')
-        revise_etype(tab, gaz, verbose=True)
+        with instrument.stage('revise_etype.sn') as st:
+            st.count(mentions=len(tab))
+            revise_etype(tab, gaz, verbose=True, stage='revise_etype.sn',
+                         vocab=resources['vocab'])
 
+    tab = list(tab)
     if outpath:
         with open(outpath, 'w') as fw:
             fw.write('\n'.join([str(i) for i in tab]))
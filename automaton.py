@@ -0,0 +1,89 @@
+class Trie(object):
+    # Compiled trie over symbol sequences (tokens or characters). States are
+    # ints and goto[state] maps a symbol to the next state, so a walk is one
+    # dict lookup per symbol and never copies the input sequence.
+    def __init__(self):
+        self.goto = [{}]
+        self.value = {}
+
+    def __len__(self):
+        return len(self.value)
+
+    def add(self, seq, value=None):
+        goto = self.goto
+        state = 0
+        for sym in seq:
+            nxt = goto[state].get(sym)
+            if nxt is None:
+                nxt = len(goto)
+                goto.append({})
+                goto[state][sym] = nxt
+            state = nxt
+        self.value[state] = value
+        return state
+
+    def walk(self, seq, start=0):
+        # Follow seq from `start` as far as the trie allows. Returns the
+        # last state reached and the index one past the last consumed symbol.
+        goto = self.goto
+        state = 0
+        end = start
+        n = len(seq)
+        while end < n:
+            nxt = goto[state].get(seq[end])
+            if nxt is None:
+                break
+            state = nxt
+            end += 1
+        return state, end
+
+    def step(self, state, sym):
+        # Next state on sym, or None
+        return self.goto[state].get(sym)
+
+    def get(self, seq, default=None):
+        state, end = self.walk(seq)
+        if end != len(seq):
+            return default
+        return self.value.get(state, default)
+
+
+class AhoCorasick(Trie):
+    # Trie with failure links. After build(), search() reports every added
+    # pattern occurring in a sequence in a single left-to-right pass.
+    def build(self):
+        goto = self.goto
+        self.fail = fail = [0] * len(goto)
+        # nearest proper suffix state that carries a value
+        self.link = link = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for sym, nxt in goto[state].items():
+                f = fail[state]
+                while f and sym not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(sym, 0)
+                fail[nxt] = f
+                link[nxt] = f if f in self.value else link[f]
+                queue.append(nxt)
+        return self
+
+    def search(self, seq):
+        # Yields (end, value) for each occurrence, end being the index one
+        # past its last symbol. Values at the same end come longest first.
+        goto = self.goto
+        fail = self.fail
+        link = self.link
+        value = self.value
+        state = 0
+        if state in value:
+            for end in range(len(seq) + 1):
+                yield end, value[state]
+        for end, sym in enumerate(seq, 1):
+            while state and sym not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(sym, 0)
+            out = state if state in value else link[state]
+            while out:
+                yield end, value[out]
+                out = link[out]
@@ -0,0 +1,191 @@
+import logging
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+import util
+import parallel
+import add_names
+import columnar
+import instrument
+import remove_names
+import rule
+
+
+logger = logging.getLogger()
+
+# Filled by the parent before the pool forks, as in parallel.py: workers
+# read resources, the compiled filters and rules, and the candidates
+# through copy-on-write pages.
+_shared = {}
+
+
+def read_runs(pruns):
+    # One 'ptab outpath' pair per line
+    res = []
+    with open(pruns, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            ptab, outpath = line.split()
+            res.append((ptab, outpath))
+    return res
+
+
+def run_one(ptab, outpath, cands, resources, filters, rule_index, opts,
+            runid='RPI_BLENDER'):
+    # The pipeline of post_processing.py over one tab, with candidates
+    # found once for all tabs. Names are written with the ids a serial run
+    # would give them. Returns (# of names, histories of run_docs).
+    with open(ptab, 'r') as f:
+        lines = list(enumerate(f))
+    res, rm_histories, rule_count, rule_histories = parallel.run_docs(
+        lines, None, resources, filters, rule_index, opts,
+        cands=add_names.copy_candidates(cands))
+    tab = [i for key, i in res]
+    for n, i in enumerate(tab):
+        i.runid = runid
+        i.qid = 'M_' + '{number:0{width}d}'.format(width=7, number=n)
+    with instrument.stage('write') as st:
+        st.count_tab(tab)
+        util.write_tab(tab, outpath)
+    return len(tab), rm_histories, rule_count, rule_histories
+
+
+def run_worker(k):
+    logging.root.setLevel(level=logging.WARNING)
+    # drop the parent's records inherited through fork
+    instrument.reset()
+    ptab, outpath = _shared['runs'][k]
+    res = run_one(ptab, outpath, _shared['cands'], _shared['resources'],
+                  _shared['filters'], _shared['rule'], _shared['opts'])
+    return res + (instrument.records(),)
+
+
+def process(pbio, runs, workers=1, lower=False, lang=None, ppsm=None,
+            pgaz=None, psn=None, pdes=None, prule=None, sn=True,
+            mtype='NAM', cache_dir=None, columns=False, compact=False,
+            fuzzy=0, matcher=None):
+    # Post-processes many tabs of the same BIO, e.g. the system runs of an
+    # ensemble, given as [(ptab, outpath)]. Resources are loaded and the
+    # BIO is scanned for candidates once; each tab is then filtered,
+    # merged with its own copy of the candidates and written as a separate
+    # post_processing.py run would write it. workers > 1 runs that many
+    # tabs at a time in a process pool.
+    resources, filters, rule_index = parallel.load(
+        lower=lower, lang=lang, ppsm=ppsm, pgaz=pgaz, psn=psn, pdes=pdes,
+        prule=prule, cache_dir=cache_dir, compact=compact, fuzzy=fuzzy,
+        matcher=matcher)
+    opts = {'sn': sn, 'mtype': mtype, 'columns': columns}
+
+    logger.info('------ FINDING CANDIDATES ------')
+    cands = add_names.find_candidates(pbio, resources, sn=sn, mtype=mtype)
+    logger.info('%s candidates' % sum(len(i) for i in cands.values()))
+
+    logger.info('------ RUNNING %s TABS ------' % len(runs))
+    if workers > 1:
+        _shared.update({
+            'opts': opts,
+            'resources': resources,
+            'filters': filters,
+            'rule': rule_index,
+            'cands': cands,
+            'runs': runs,
+        })
+        ctx = multiprocessing.get_context('fork')
+        try:
+            with instrument.stage('workers'):
+                with ctx.Pool(min(workers, len(runs))) as pool:
+                    results = pool.map(run_worker, range(len(runs)))
+        finally:
+            _shared.clear()
+        for k, res in enumerate(results):
+            instrument.extend(res[-1], shard=k)
+    else:
+        results = [run_one(ptab, outpath, cands, resources, filters,
+                           rule_index, opts) for ptab, outpath in runs]
+
+    rm_histories = defaultdict(int)
+    rule_count = defaultdict(int)
+    rule_histories = defaultdict(int)
+    for (ptab, outpath), res in zip(runs, results):
+        n, rmh, rc, rh = res[:4]
+        logger.info('%s: %s names written to %s' % (ptab, n, outpath))
+        for i, c in rmh.items():
+            rm_histories[i] += c
+        for i, c in rc.items():
+            rule_count[i] += c
+        for i, c in rh.items():
+            rule_histories[i] += c
+
+    logger.info('\n------ REMOVING NAMES (all tabs) ------')
+    remove_names.log_histories(rm_histories)
+    if prule:
+        logger.info('------ APPLYING RULES (all tabs) ------')
+        rule.log_histories(rule_count, rule_histories)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
+    logging.root.setLevel(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pbio', type=str, help='path to bio')
+    parser.add_argument('--run', type=str, nargs=2, action='append',
+                        default=[], metavar=('PTAB', 'OUTPATH'),
+                        help='tab to post-process and its output path; '
+                        'may be repeated')
+    parser.add_argument('--runs', type=str,
+                        help='path to a file of "ptab outpath" lines')
+    parser.add_argument('--ppsm', type=str, help='path to psm')
+    parser.add_argument('--pgaz', type=str, help='path to gaz')
+    parser.add_argument('--psn', type=str, help='path to sn gaz')
+    parser.add_argument('--pdes', type=str, help='path to des')
+    parser.add_argument('--prule', type=str, help='path to rules file')
+    parser.add_argument('--lower', action='store_true', default=False,
+                        help='lowercase mode')
+    parser.add_argument('--lang', type=str, choices=sorted(
+        i for i in remove_names.VALID_CHAR_RANGES if i),
+        help='language of valid chars')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory of compiled gaz and rule caches')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='# of processes, each handling whole tabs')
+    parser.add_argument('--report', type=str,
+                        help='path of a JSON report of per-stage timing, '
+                        'throughput and memory')
+    parser.add_argument('--columnar', action='store_true', default=False,
+                        help='resolve conflicts and filter names over '
+                        'columnar NumPy arrays')
+    parser.add_argument('--compact-gaz', action='store_true', default=False,
+                        help='keep gazetteers in compact arrays')
+    parser.add_argument('--fuzzy', type=int, default=0,
+                        help='also match gazetteer entries within this '
+                        'edit distance in SN and DF documents, as p2; only '
+                        'SN names with the char gazetteer matcher')
+    parser.add_argument('--gaz-matcher', type=str, choices=add_names.MATCHERS,
+                        help='match gazetteers on tokens or characters, by '
+                        'default characters for %s' % ', '.join(
+                            add_names.CHAR_LANGS))
+    args = parser.parse_args()
+    runs = [tuple(i) for i in args.run]
+    if args.runs:
+        runs += read_runs(args.runs)
+    if not runs:
+        parser.error('no tabs given, use --run or --runs')
+    if len(set(outpath for ptab, outpath in runs)) != len(runs):
+        parser.error('two runs write the same output path')
+    if args.columnar and not columnar.available():
+        parser.error('--columnar needs numpy')
+    if args.report:
+        instrument.enable()
+
+    process(args.pbio, runs, workers=args.workers, lower=args.lower,
+            lang=args.lang, ppsm=args.ppsm, pgaz=args.pgaz, psn=args.psn,
+            pdes=args.pdes, prule=args.prule, cache_dir=args.cache_dir,
+            columns=args.columnar, compact=args.compact_gaz,
+            fuzzy=args.fuzzy, matcher=args.gaz_matcher)
+
+    if args.report:
+        instrument.write_report(args.report)
+    logger.info('done.\n')
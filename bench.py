@@ -0,0 +1,499 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+import util
+import interval
+import gazetteer
+import add_names
+import remove_names
+import rule
+import trans_tab
+
+
+logger = logging.getLogger()
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
+logging.root.setLevel(level=logging.INFO)
+
+
+def synth_vocab(size, seed=0):
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    res = set()
+    while len(res) < size:
+        res.add(''.join(rng.choice(letters)
+                        for _ in range(rng.randint(3, 9))).capitalize())
+    return sorted(res)
+
+
+def synth_bio(n_docs, n_toks, vocab, seed=0):
+    rng = random.Random(seed)
+    res = {}
+    for d in range(n_docs):
+        docid = 'DF_SYNTH_%06d' % d
+        toks = []
+        beg = 0
+        for _ in range(n_toks):
+            tok = rng.choice(vocab)
+            toks.append((tok, beg, beg + len(tok) - 1))
+            beg += len(tok) + 1
+        res[docid] = toks
+    return res
+
+
+def synth_gaz(n_entries, vocab, max_len=4, seed=0):
+    rng = random.Random(seed)
+    gaz = {}
+    while len(gaz) < n_entries:
+        mention = ' '.join(rng.choice(vocab)
+                           for _ in range(rng.randint(1, max_len)))
+        gaz[mention] = (rng.choice(['PER', 'ORG', 'GPE', 'LOC']),
+                        rng.choice(['p', 'p2']), None)
+    return gaz
+
+
+def legacy_add_gazetteer(bio, gaz, gaz_tree, des=None, mtype='NAM'):
+    # The nested-dict walk add_gazetteer used before the compiled trie; kept
+    # here as the reference for output equality and timing.
+    res_trusted = []
+    res_untrusted = []
+    count = 0
+    for docid in bio:
+        for i, (tok, beg, end) in enumerate(bio[docid]):
+            if tok in gaz_tree:
+                tree = gaz_tree[tok]
+                mention = [tok]
+                offset = [(beg, end)]
+                for j, (next_tok, next_beg, next_end) in \
+                    enumerate(bio[docid][i+1:]):
+                    if next_tok in tree:
+                        tree = tree[next_tok]
+                        mention.append(next_tok)
+                        offset.append((next_beg, next_end))
+                    else:
+                        break
+                mention = ' '.join(mention)
+                if mention in gaz:
+                    etype, op, additional_info = gaz[mention]
+                    if des:
+                        prev_tok, prev_beg, prev_end = bio[docid][i-1]
+                        if prev_tok in des:
+                            etype = des[prev_tok][0]
+                            mention = '%s %s' % (prev_tok, mention)
+                            offset = [(prev_beg, prev_end)] + offset
+                    offset = '%s:%s-%s' % (docid, offset[0][0], offset[-1][1])
+                    qid = 'GAZ_' + '{number:0{width}d}'.format(width=7,
+                                                               number=count)
+                    tt = util.TacTab('Gazetterr', qid, mention, offset, 'NIL',
+                                     etype, mtype, '1.0',
+                                     trans=additional_info)
+                    if op == 'p':
+                        res_trusted.append(tt)
+                    else:
+                        res_untrusted.append(tt)
+                    count += 1
+    return res_trusted, res_untrusted
+
+
+def build_gaz_tree(gaz):
+    res_tree = {}
+    for mention in gaz:
+        tree = res_tree
+        for tok in mention.split(' '):
+            if tok not in tree:
+                tree[tok] = {}
+            tree = tree[tok]
+    return res_tree
+
+
+def timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - start
+
+
+def measure(func, *args, **kwargs):
+    # (result, bytes still allocated by func once it returns)
+    tracemalloc.start()
+    try:
+        res = func(*args, **kwargs)
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return res, size
+
+
+def bench_gazetteer(n_docs, n_toks, n_entries, vocab_size):
+    vocab = synth_vocab(vocab_size)
+    bio = synth_bio(n_docs, n_toks, vocab)
+    gaz = synth_gaz(n_entries, vocab)
+
+    logger.info('--- add_gazetteer: %s docs x %s toks, %s entries ---' %
+                (n_docs, n_toks, n_entries))
+    tree, t_legacy_build = timeit(build_gaz_tree, gaz)
+    trie, t_build = timeit(util.build_gaz_trie, gaz)
+    legacy, t_legacy = timeit(legacy_add_gazetteer, bio, gaz, tree)
+    compact, t_compact_build = timeit(gazetteer.CompactGaz.build, gaz)
+    compiled, t_compiled = timeit(add_names.add_gazetteer, bio, gaz, trie)
+    packed, t_compact = timeit(add_names.add_gazetteer, bio, compact,
+                               compact)
+    for old, new, small in zip(legacy, compiled, packed):
+        assert [str(i) for i in old] == [str(i) for i in new]
+        assert [i.trans for i in old] == [i.trans for i in new]
+        assert [str(i) for i in small] == [str(i) for i in new]
+        assert [i.trans for i in small] == [i.trans for i in new]
+
+    # memory of the gazetteer as loaded from a file: mapping plus trie
+    # against one CompactGaz
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pgaz = os.path.join(tmpdir, 'gaz')
+        with open(pgaz, 'w') as fw:
+            for mention, (etype, op, info) in gaz.items():
+                fw.write('%s\t%s\t%s\n' % (mention, etype, op))
+        m_dict = measure(util.read_gaz, pgaz)[1]
+        m_compact = measure(gazetteer.read_gaz, pgaz)[1]
+    logger.info('  build: nested dict %.3fs, compiled trie %.3fs, '
+                'compact %.3fs' % (t_legacy_build, t_build, t_compact_build))
+    logger.info('  match: nested dict %.3fs, compiled trie %.3fs (x%.1f), '
+                'compact %.3fs' % (t_legacy, t_compiled,
+                                   t_legacy / max(t_compiled, 1e-9),
+                                   t_compact))
+    logger.info('  memory: dict + trie %.1fMB, compact %.1fMB' %
+                (m_dict / 1e6, m_compact / 1e6))
+    logger.info('  p: %s, p2: %s' % (len(compiled[0]), len(compiled[1])))
+    return {
+        'params': {'docs': n_docs, 'toks': n_toks, 'gaz': n_entries,
+                   'vocab': vocab_size},
+        'build': {'nested_dict': t_legacy_build, 'compiled_trie': t_build,
+                  'compact': t_compact_build},
+        'match': {'nested_dict': t_legacy, 'compiled_trie': t_compiled,
+                  'compact': t_compact},
+        'memory': {'dict_trie': m_dict, 'compact': m_compact},
+    }
+
+
+def synth_tab(n_mentions, vocab, seed=0):
+    rng = random.Random(seed)
+    odd = ['1234', '#!', 'http://t.co/x', '12:30', 'img.jpg',
+           '\u0b05\u0b06', '\u4e2d\u6587', ' '.join(vocab[:20])]
+    res = []
+    for n in range(n_mentions):
+        if rng.random() < 0.1:
+            mention = rng.choice(odd)
+        else:
+            mention = ' '.join(rng.choice(vocab)
+                               for _ in range(rng.randint(1, 3)))
+        docid = rng.choice(['DF_', 'SN_', 'NW_']) + 'SYNTH_%06d' % (n // 50)
+        beg = rng.randint(0, 5000)
+        offset = '%s:%s-%s' % (docid, beg, beg + len(mention) - 1)
+        res.append(util.TacTab('SYNTH', 'M_%07d' % n, mention, offset, 'NIL',
+                               rng.choice(['PER', 'ORG', 'GPE', 'LOC']),
+                               'NAM', '1.0'))
+    return res
+
+
+def bench_filters(n_mentions, vocab_size):
+    vocab = synth_vocab(vocab_size)
+    tab = synth_tab(n_mentions, vocab)
+
+    logger.info('--- remove_names filters: %s names ---' % n_mentions)
+    res = {'params': {'names': n_mentions, 'vocab': vocab_size}}
+    for name, f in remove_names.build_filters(
+            list(remove_names.FILTERS), psm={}):
+        hits, t = timeit(lambda: [f(i) for i in tab])
+        hits = len([i for i in hits if i])
+        logger.info('  %-10s %.3fs, %.0f names/s, %s hits' %
+                    (name, t, n_mentions / max(t, 1e-9), hits))
+        res[name] = {'seconds': t, 'hits': hits}
+    logging.root.setLevel(level=logging.WARNING)
+    new_tab, t = timeit(remove_names.process, tab, verbose=False)
+    logging.root.setLevel(level=logging.INFO)
+    logger.info('  %-10s %.3fs, %.0f names/s, %s removed' %
+                ('chain', t, n_mentions / max(t, 1e-9),
+                 n_mentions - len(new_tab)))
+    res['chain'] = {'seconds': t, 'hits': n_mentions - len(new_tab)}
+    return res
+
+
+def generate(outdir, n_docs=1000, n_toks=500, n_gaz=100000, n_rules=1000,
+             overlap=0.3, vocab_size=20000, seed=0):
+    # Writes a synthetic corpus (bio, tab, psm, gaz, des, sn, rule and dict
+    # files) under outdir. `overlap` is both the share of gazetteer entries
+    # taken from n-grams of the documents and the chance that a tab name
+    # overlaps the name before it.
+    rng = random.Random(seed)
+    vocab = synth_vocab(vocab_size, seed=seed)
+    etypes = ['PER', 'ORG', 'GPE', 'LOC']
+    designators = ['Mr', 'Dr', 'Gen', 'Lake', 'Mount']
+    odd = ['1234', '#!', 'http://t.co/x', '12:30', 'img.jpg', '\u4e2d\u6587']
+    os.makedirs(outdir, exist_ok=True)
+    paths = dict((i, os.path.join(outdir, i))
+                 for i in ['in.bio', 'in.tab', 'in.psm', 'gaz', 'des', 'sn',
+                           'rule', 'dic'])
+
+    ngrams = []
+    n_names = 0
+    with open(paths['in.bio'], 'w') as fbio, \
+         open(paths['in.tab'], 'w') as ftab, \
+         open(paths['in.psm'], 'w') as fpsm:
+        for d in range(n_docs):
+            docid = '%sSYNTH_%06d' % (['DF_', 'SN_', 'NW_'][d % 3], d)
+            toks = []
+            beg = 0
+            for n in range(n_toks):
+                r = rng.random()
+                if r < 0.02:
+                    tok = rng.choice(designators)
+                elif r < 0.07 and docid.startswith('SN_'):
+                    tok = rng.choice('#@') + rng.choice(vocab)
+                else:
+                    tok = rng.choice(vocab)
+                toks.append((tok, beg, beg + len(tok) - 1))
+                fbio.write('%s %s:%s-%s O\n' % (tok, docid, beg,
+                                                 beg + len(tok) - 1))
+                if n % 20 == 19:
+                    fbio.write('\n')
+                beg += len(tok) + 1
+            fbio.write('\n')
+
+            if docid.startswith('DF_'):
+                for tok, b, e in rng.sample(toks, min(2, len(toks))):
+                    fpsm.write('post\t%s\t%s\t%s\t%s\n' %
+                               (docid, b, e, tok))
+
+            i = 0
+            while i < len(toks):
+                i += rng.randint(1, 20)
+                if i >= len(toks):
+                    break
+                j = min(len(toks), i + rng.randint(1, 3))
+                if rng.random() < 0.05:
+                    mention = rng.choice(odd)
+                else:
+                    mention = ' '.join(t[0] for t in toks[i:j])
+                ftab.write('SYNTH\tM_%07d\t%s\t%s:%s-%s\tNIL\t%s\tNAM\t1.0\n'
+                           % (n_names, mention, docid, toks[i][1],
+                              toks[j-1][2], rng.choice(etypes)))
+                n_names += 1
+                if rng.random() < overlap:
+                    i = max(0, j - 1 - rng.randint(0, 1))
+                else:
+                    i = j
+
+            for _ in range(int(n_gaz * overlap / n_docs) + 1):
+                i = rng.randrange(len(toks))
+                ngrams.append(' '.join(t[0] for t in
+                                       toks[i:i+rng.randint(1, 3)]))
+
+    with open(paths['gaz'], 'w') as fw:
+        entries = set(ngrams[:int(n_gaz * overlap)])
+        while len(entries) < n_gaz:
+            entries.add(' '.join(rng.choice(vocab)
+                                 for _ in range(rng.randint(1, 3))))
+        for mention in sorted(entries):
+            fw.write('%s\t%s\t%s\n' % (mention, rng.choice(etypes + ['-']),
+                                        rng.choice(['p', 'p2'])))
+    with open(paths['des'], 'w') as fw:
+        for tok in designators:
+            fw.write('%s\t%s\tp\n' % (tok, rng.choice(etypes)))
+    with open(paths['sn'], 'w') as fw:
+        for tok in rng.sample(vocab, min(len(vocab), 100)):
+            fw.write('#%s\t%s\tp\n' % (tok, rng.choice(etypes + ['-'])))
+            fw.write('@%s\tPER\tp\n' % tok)
+    with open(paths['rule'], 'w') as fw:
+        for n in range(n_rules):
+            tok = rng.choice(vocab)
+            op = ['mv', 'rm', 'in_rm'][n % 3]
+            if op == 'in_rm':
+                tok = tok[:4] if rng.random() < 0.1 else tok
+            args = [rng.choice(etypes)] if op == 'mv' else ['synthetic']
+            fw.write('\t'.join([tok, rng.choice(etypes + ['ALL']), op] +
+                                args) + '\n')
+    with open(paths['dic'], 'w') as fw:
+        for tok in vocab:
+            for _ in range(rng.randint(1, 3)):
+                fw.write('%s\t%s\n' % (tok, rng.choice(vocab).lower()))
+    with open(os.path.join(outdir, 'params.json'), 'w') as fw:
+        json.dump({'docs': n_docs, 'toks': n_toks, 'gaz': n_gaz,
+                   'rules': n_rules, 'overlap': overlap,
+                   'vocab': vocab_size, 'seed': seed}, fw, sort_keys=True)
+    return paths
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(paths, lower=False):
+    # Times every pipeline stage on its own over the files from generate()
+    stages = {}
+
+    def run(name, func, *args, **kwargs):
+        res, t = timeit(func, *args, **kwargs)
+        stages[name] = {'seconds': t}
+        return res
+
+    def count(name, **kwargs):
+        for k, v in kwargs.items():
+            stages[name][k] = v
+            stages[name]['%s_per_s' % k] = v / max(stages[name]['seconds'],
+                                                   1e-9)
+
+    level = logging.root.level
+    logging.root.setLevel(level=logging.WARNING)
+    try:
+        tab = run('read_tab', util.read_tab, paths['in.tab'])
+        count('read_tab', names=len(tab))
+        bio = run('read_bio', util.read_bio, paths['in.bio'])
+        n_docs = len(bio)
+        n_toks = sum(len(i) for i in bio.values())
+        count('read_bio', docs=n_docs, toks=n_toks)
+        bio = run('read_bio_compact', util.read_bio, paths['in.bio'],
+                  compact=True)
+        count('read_bio_compact', docs=n_docs, toks=n_toks)
+        psm = run('read_psm', util.read_psm, paths['in.psm'])
+        gaz, gaz_tree = run('read_gaz', util.read_gaz, paths['gaz'],
+                            lower=lower)
+        count('read_gaz', entries=len(gaz))
+        des, des_tree = util.read_gaz(paths['des'], lower=lower)
+        sn, sn_tree = util.read_gaz(paths['sn'], lower=lower)
+        vocab = util.new_vocab(lower)
+        rules = run('read_rule', util.read_rule, paths['rule'], lower=lower)
+        count('read_rule', rules=len(rules))
+
+        n = len(tab)
+        tab = run('remove_names', remove_names.process, tab, verbose=False)
+        count('remove_names', names=n)
+
+        index = interval.MentionIndex(tab)
+        pa = run('add_poster_author', add_names.add_poster_author, bio, psm)
+        count('add_poster_author', docs=n_docs, toks=n_toks)
+        run('check_conflicts_duo_tab:poster_author',
+            add_names.check_conflicts_duo_tab, index, pa, trust_new=True)
+        count('check_conflicts_duo_tab:poster_author', names=len(pa))
+
+        p, p2 = run('add_gazetteer', add_names.add_gazetteer, bio, gaz,
+                    gaz_tree, des=des, vocab=vocab)
+        count('add_gazetteer', docs=n_docs, toks=n_toks)
+        n = len(p) + len(p2)
+        p = run('check_conflicts_single_tab:p',
+                add_names.check_conflicts_single_tab, p)
+        count('check_conflicts_single_tab:p', names=n - len(p2))
+        p2 = run('check_conflicts_single_tab:p2',
+                 add_names.check_conflicts_single_tab, p2)
+        run('check_conflicts_duo_tab:p', add_names.check_conflicts_duo_tab,
+            index, p, trust_new=True, verbose=True)
+        count('check_conflicts_duo_tab:p', names=len(p))
+        run('check_conflicts_duo_tab:p2', add_names.check_conflicts_duo_tab,
+            index, p2, trust_new=False, verbose=True)
+        count('check_conflicts_duo_tab:p2', names=len(p2))
+        run('revise_etype:gaz', add_names.revise_etype, index, gaz,
+            verbose=True, vocab=vocab)
+        count('revise_etype:gaz', names=len(index))
+
+        sn_names = run('add_sn', add_names.add_sn, bio, gaz=sn, vocab=vocab)
+        count('add_sn', docs=n_docs, toks=n_toks)
+        run('check_conflicts_duo_tab:sn', add_names.check_conflicts_duo_tab,
+            index, sn_names, trust_new=True, verbose=True, verbose_thres=5)
+        count('check_conflicts_duo_tab:sn', names=len(sn_names))
+        run('revise_etype:sn', add_names.revise_etype, index, sn,
+            verbose=True, vocab=vocab)
+
+        tab = list(index)
+        n = len(tab)
+        tab = run('rule', rule.process, tab, paths['rule'], lower=lower,
+                  verbose=False)
+        count('rule', names=n)
+
+        lines = [str(i) for i in tab]
+        run('trans_tab', trans_tab.main, paths['dic'], lines)
+        count('trans_tab', names=len(lines))
+    finally:
+        logging.root.setLevel(level=level)
+
+    for name, res in stages.items():
+        logger.info('  %-40s %8.3fs' % (name, res['seconds']))
+    params = {'paths': paths, 'lower': lower}
+    pparams = os.path.join(os.path.dirname(paths['in.tab']), 'params.json')
+    if os.path.exists(pparams):
+        with open(pparams, 'r') as f:
+            params['corpus'] = json.load(f)
+    return {
+        'params': params,
+        'stages': stages,
+        'total_seconds': sum(i['seconds'] for i in stages.values()),
+    }
+
+
+BENCHMARKS = ['suite', 'gazetteer', 'filters']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=200, help='# of documents')
+    parser.add_argument('--toks', type=int, default=5000,
+                        help='# of tokens per document')
+    parser.add_argument('--gaz', type=int, default=100000,
+                        help='# of gazetteer entries')
+    parser.add_argument('--rules', type=int, default=1000,
+                        help='# of rules')
+    parser.add_argument('--overlap', type=float, default=0.3,
+                        help='overlap density of names and gazetteer hits')
+    parser.add_argument('--vocab', type=int, default=20000, help='vocab size')
+    parser.add_argument('--names', type=int, default=1000000,
+                        help='# of names in the tab')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--lower', action='store_true', default=False,
+                        help='lowercase mode')
+    parser.add_argument('--data', type=str, default='bench_data',
+                        help='directory of the synthetic corpus; generated '
+                        'unless it already exists')
+    parser.add_argument('--json', type=str,
+                        help='path of the JSON report, stdout by default')
+    parser.add_argument('benchmarks', nargs='*', default=['suite'],
+                        help='benchmarks to run: %s' % BENCHMARKS)
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if 'suite' in args.benchmarks:
+        if not os.path.exists(args.data):
+            logger.info('generating synthetic corpus in %s...' % args.data)
+            generate(args.data, n_docs=args.docs, n_toks=args.toks,
+                     n_gaz=args.gaz, n_rules=args.rules,
+                     overlap=args.overlap, vocab_size=args.vocab,
+                     seed=args.seed)
+        paths = dict((i, os.path.join(args.data, i))
+                     for i in ['in.bio', 'in.tab', 'in.psm', 'gaz', 'des',
+                               'sn', 'rule', 'dic'])
+        logger.info('--- pipeline stages: %s ---' % args.data)
+        report['suite'] = bench_suite(paths, lower=args.lower)
+    if 'gazetteer' in args.benchmarks:
+        report['gazetteer'] = bench_gazetteer(args.docs, args.toks, args.gaz,
+                                              args.vocab)
+    if 'filters' in args.benchmarks:
+        report['filters'] = bench_filters(args.names, args.vocab)
+
+    if args.json:
+        with open(args.json, 'w') as fw:
+            json.dump(report, fw, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
@@ -0,0 +1,192 @@
+import os
+import mmap
+import struct
+import marshal
+import hashlib
+import logging
+import argparse
+from collections import defaultdict
+
+import util
+import gazetteer
+from automaton import Trie, AhoCorasick
+
+
+logger = logging.getLogger()
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
+logging.root.setLevel(level=logging.INFO)
+
+# Bump whenever the layout of a cached payload changes
+CACHE_VERSION = 2
+MAGIC = b'PPCACHE\0'
+HEADER = struct.Struct('<8sI')
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(cache_dir, path, kind, lower):
+    key = '%s\t%s\t%s' % (os.path.abspath(path), kind, lower)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s.%s.cache' % (name, kind))
+
+
+def read_artifact(pcache):
+    # Returns (header, payload) or None if the file is not a cache artifact
+    if not os.path.exists(pcache):
+        return None
+    with open(pcache, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < HEADER.size:
+                return None
+            magic, header_len = HEADER.unpack_from(mm)
+            if magic != MAGIC:
+                return None
+            with memoryview(mm) as view:
+                header = marshal.loads(view[HEADER.size:
+                                            HEADER.size + header_len])
+                if header['version'] != CACHE_VERSION:
+                    return header, None
+                payload = marshal.loads(view[HEADER.size + header_len:])
+    return header, payload
+
+
+def write_artifact(pcache, header, payload):
+    header = marshal.dumps(header)
+    tmp = '%s.%s.tmp' % (pcache, os.getpid())
+    with open(tmp, 'wb') as fw:
+        fw.write(HEADER.pack(MAGIC, len(header)))
+        fw.write(header)
+        marshal.dump(payload, fw)
+    os.replace(tmp, pcache)
+
+
+def load(path, kind, lower, build, cache_dir):
+    # Returns build(path, lower) through a cached artifact in cache_dir.
+    # An artifact is reused when its version, kind and lowercase flag match
+    # and the source is unchanged: same size and mtime, or failing that the
+    # same content hash.
+    pcache = cache_path(cache_dir, path, kind, lower)
+    st = os.stat(path)
+    artifact = read_artifact(pcache)
+    digest = None
+    if artifact and artifact[1] is not None:
+        header, payload = artifact
+        if header['kind'] == kind and header['lower'] == lower:
+            if (header['size'], header['mtime']) == (st.st_size,
+                                                     st.st_mtime_ns):
+                logger.info('loaded cache %s' % pcache)
+                return payload
+            digest = file_digest(path)
+            if header['sha1'] == digest:
+                header['size'] = st.st_size
+                header['mtime'] = st.st_mtime_ns
+                write_artifact(pcache, header, payload)
+                logger.info('loaded cache %s' % pcache)
+                return payload
+
+    logger.info('compiling %s -> %s' % (path, pcache))
+    payload = build(path, lower)
+    header = {
+        'version': CACHE_VERSION,
+        'kind': kind,
+        'lower': lower,
+        'source': os.path.abspath(path),
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'sha1': digest or file_digest(path),
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    write_artifact(pcache, header, payload)
+    return payload
+
+
+def build_gaz(path, lower):
+    res, res_tree = util.read_gaz(path, lower=lower)
+    return res, res_tree.goto, res_tree.value
+
+
+def build_compact_gaz(path, lower):
+    return gazetteer.CompactGaz.build(
+        util.read_gaz_entries(path, lower=lower)).dump()
+
+
+def build_gaz_chars(path, lower):
+    res = util.build_gaz_chars(util.read_gaz_entries(path, lower=lower))
+    return res.goto, res.value, res.fail, res.link
+
+
+def build_rule(path, lower):
+    rule = util.read_rule(path, lower=lower)
+    exact, in_rm = util.compile_rule(rule)
+    return dict(rule), exact, in_rm.goto, in_rm.value, in_rm.fail, in_rm.link
+
+
+def read_gaz(pgaz, lower=False, cache_dir=None, compact=False):
+    # With compact, the mapping and the trie are one gazetteer.CompactGaz
+    if compact:
+        if not cache_dir:
+            return gazetteer.read_gaz(pgaz, lower=lower)
+        res = gazetteer.CompactGaz.load(load(pgaz, 'gaz.compact', lower,
+                                             build_compact_gaz, cache_dir))
+        return res, res
+    if not cache_dir:
+        return util.read_gaz(pgaz, lower=lower)
+    res, goto, value = load(pgaz, 'gaz', lower, build_gaz, cache_dir)
+    res_tree = Trie()
+    res_tree.goto = goto
+    res_tree.value = value
+    return res, res_tree
+
+
+def read_gaz_chars(pgaz, lower=False, cache_dir=None):
+    # Character automaton of util.build_gaz_chars
+    if not cache_dir:
+        return util.build_gaz_chars(util.read_gaz_entries(pgaz, lower=lower))
+    res = AhoCorasick()
+    res.goto, res.value, res.fail, res.link = load(
+        pgaz, 'gaz.chars', lower, build_gaz_chars, cache_dir)
+    return res
+
+
+def read_rule(prule, lower=False, cache_dir=None):
+    # (rule table, exact index, in_rm automaton) of util.compile_rule
+    if not cache_dir:
+        rule = util.read_rule(prule, lower=lower)
+        return (rule,) + util.compile_rule(rule)
+    rule, exact, goto, value, fail, link = load(prule, 'rule', lower,
+                                                build_rule, cache_dir)
+    res = defaultdict(dict)
+    res.update(rule)
+    in_rm = AhoCorasick()
+    in_rm.goto, in_rm.value, in_rm.fail, in_rm.link = goto, value, fail, link
+    return res, exact, in_rm
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cache_dir', type=str, help='cache directory')
+    parser.add_argument('--pgaz', type=str, nargs='*', default=[],
+                        help='paths to gaz, des or sn lists')
+    parser.add_argument('--prule', type=str, nargs='*', default=[],
+                        help='paths to rules files')
+    parser.add_argument('--lower', action='store_true', default=False,
+                        help='lowercase mode')
+    parser.add_argument('--compact-gaz', action='store_true', default=False,
+                        help='compile compact gazetteers')
+    parser.add_argument('--gaz-chars', action='store_true', default=False,
+                        help='also compile character automata of the gaz')
+    args = parser.parse_args()
+
+    for pgaz in args.pgaz:
+        read_gaz(pgaz, lower=args.lower, cache_dir=args.cache_dir,
+                 compact=args.compact_gaz)
+        if args.gaz_chars:
+            read_gaz_chars(pgaz, lower=args.lower, cache_dir=args.cache_dir)
+    for prule in args.prule:
+        read_rule(prule, lower=args.lower, cache_dir=args.cache_dir)
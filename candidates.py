@@ -0,0 +1,316 @@
+import string
+import logging
+
+import util
+from util import TacTab
+
+
+logger = logging.getLogger()
+
+# Deletes punctuation, to tell hashtags and handles made of nothing else
+PUNCT_TABLE = str.maketrans('', '', string.punctuation)
+
+
+class Matcher(object):
+    # Base of the candidate generators run by scan(). Each defines
+    # match(docid, doc, toks, keys), which sees each document once, in BIO
+    # order, with its tokens and their lookup keys, and appends candidates
+    # to the lists of self.res, one per stream. docids, when set, is a
+    # substring the docids of its documents must contain.
+    streams = ()
+    docids = None
+
+    def __init__(self):
+        self.res = dict((i, []) for i in self.streams)
+        self.count = 0
+
+    def wants(self, docid):
+        return self.docids is None or self.docids in docid
+
+
+def scan(bio, matchers, vocab=None):
+    # Walks the documents once for all matchers, reading, decoding and
+    # folding each document a single time. Returns {stream: candidates}.
+    for docid, doc in util.iter_docs(bio):
+        active = [m for m in matchers if m.wants(docid)]
+        if not active:
+            continue
+        toks = doc.toks if isinstance(doc, util.BioDoc) else \
+            [tok for tok, beg, end in doc]
+        keys = toks if vocab is None else vocab.keys(toks)
+        for m in active:
+            m.match(docid, doc, toks, keys)
+    res = {}
+    for m in matchers:
+        res.update(m.res)
+    return res
+
+
+class PosterAuthorMatcher(Matcher):
+    # Tokens of a discussion forum post that are one of its posters
+    streams = ('poster_author',)
+    docids = 'DF_'
+
+    def __init__(self, psm):
+        Matcher.__init__(self)
+        self.psm = psm
+
+    def match(self, docid, doc, toks, keys):
+        posters = self.psm.get(docid)
+        if not posters:
+            return
+        res = self.res['poster_author']
+        for tok, beg, end in doc:
+            if tok in posters:
+                offset = '%s:%s-%s' % (docid, beg, end)
+                qid = 'DFPA_' + '{number:0{width}d}'.format(width=7,
+                                                            number=self.count)
+                res.append(TacTab('DF_poster_author', qid, tok, offset,
+                                  'NIL', 'PER', 'NAM', '1.0'))
+                self.count += 1
+
+
+class GazetteerMatcher(Matcher):
+    # Gazetteer entries over BIO tokens. Trusted (p) entries go to the p
+    # stream and untrusted (p2) ones to p2. In lowercase mode tokens are
+    # matched by their folded keys and names keep the case of the
+    # document. With a fuzzy index, noisy documents also get the longest
+    # approximate match at each token when it is longer than the exact one,
+    # always as p2.
+    streams = ('p', 'p2')
+
+    def __init__(self, gaz, gaz_tree, des=None, mtype='NAM', fuzzy=None,
+                 lower=False):
+        Matcher.__init__(self)
+        self.gaz = gaz
+        self.gaz_tree = gaz_tree
+        self.des = des
+        self.mtype = mtype
+        self.fuzzy = fuzzy
+        self.lower = lower
+
+    def emit(self, mention, offset, etype, op, trans):
+        qid = 'GAZ_' + '{number:0{width}d}'.format(width=7,
+                                                   number=self.count)
+        tt = TacTab('Gazetterr', qid, mention, offset, 'NIL', etype,
+                    self.mtype, '1.0', trans=trans)
+        if op == 'p':
+            self.res['p'].append(tt)
+        elif op == 'p2':
+            self.res['p2'].append(tt)
+        else:
+            logger.error('unrecognized op: %s' % op)
+            exit()
+        self.count += 1
+
+    def match(self, docid, doc, toks, keys):
+        gaz = self.gaz
+        gaz_tree = self.gaz_tree
+        des = self.des
+        approx = self.fuzzy is not None and self.fuzzy.is_noisy(docid)
+        for i in range(len(keys)):
+            # Follow the longest path through the compiled gazetteer trie that
+            # starts at token i; it is a match only if the path is an entry.
+            matches = []
+            state, j = gaz_tree.walk(keys, i)
+            mention = gaz_tree.value.get(state) if j > i else None
+            if mention is not None and mention in gaz:
+                matches.append((j, mention, False))
+            if approx:
+                hit = self.fuzzy.walk(gaz_tree, keys, i)
+                if hit is not None and \
+                   (not matches or hit[1] > matches[0][0]):
+                    matches.append((hit[1], gaz_tree.value.get(hit[0]),
+                                    True))
+            for j, mention, is_approx in matches:
+                etype, op, additional_info = gaz[mention]
+                if is_approx:
+                    op = 'p2'
+                if self.lower or is_approx:
+                    mention = ' '.join(toks[i:j])
+                offset = [(doc[i][1], doc[i][2]),
+                          (doc[j-1][1], doc[j-1][2])]
+
+                if des and i > 0:
+                    prev_tok, prev_beg, prev_end = doc[i-1]
+                    if keys[i-1] in des:
+                        etype = des[keys[i-1]][0]
+                        mention = '%s %s' % (prev_tok, mention)
+                        offset = [(prev_beg, prev_end)] + offset
+
+                offset = '%s:%s-%s' % (docid, offset[0][0], offset[-1][1])
+                self.emit(mention, offset, etype, op, additional_info)
+
+
+def is_word_char(c):
+    return c.isascii() and c.isalnum()
+
+
+def doc_chars(doc, keys):
+    # Characters of a document's tokens, the whitespace between tokens left
+    # out. Returns the characters to match (from keys), the original ones,
+    # their document offsets, the token of each character and whether a
+    # match may start and end at it: not inside a run of ASCII letters and
+    # digits, so a Latin word in the text only matches whole.
+    chars = []
+    raw = []
+    offsets = []
+    tok_of = []
+    can_start = []
+    can_end = []
+    for n, ((tok, beg, end), key) in enumerate(zip(doc, keys)):
+        if len(key) != len(tok):
+            key = tok
+        for k, c in enumerate(key):
+            chars.append(c)
+            raw.append(tok[k])
+            offsets.append(beg + k)
+            tok_of.append(n)
+            can_start.append(k == 0 or not (is_word_char(key[k-1]) and
+                                            is_word_char(c)))
+            can_end.append(k == len(key) - 1 or
+                           not (is_word_char(c) and
+                                is_word_char(key[k+1])))
+    return chars, raw, offsets, tok_of, can_start, can_end
+
+
+class CharGazetteerMatcher(GazetteerMatcher):
+    # GazetteerMatcher for languages without spaces: the character automaton
+    # of util.build_gaz_chars finds every entry in the text of a document in
+    # one pass, and the longest entry starting at each character is a
+    # match. Names are spelled as in the document, with a space wherever
+    # the text had whitespace.
+    def __init__(self, gaz, gaz_chars, des=None, mtype='NAM'):
+        GazetteerMatcher.__init__(self, gaz, None, des=des, mtype=mtype)
+        self.gaz_chars = gaz_chars
+
+    def match(self, docid, doc, toks, keys):
+        gaz = self.gaz
+        des = self.des
+        chars, raw, offsets, tok_of, can_start, can_end = \
+            doc_chars(doc, keys)
+        longest = {}
+        for end, (mention, n) in self.gaz_chars.search(chars):
+            start = end - n
+            # a later end at the same start is a longer entry
+            if can_start[start] and can_end[end-1]:
+                longest[start] = (end, mention)
+        for start in sorted(longest):
+            end, mention = longest[start]
+            if mention not in gaz:
+                continue
+            etype, op, additional_info = gaz[mention]
+            mention = raw[start]
+            for k in range(start + 1, end):
+                if offsets[k] > offsets[k-1] + 1:
+                    mention += ' '
+                mention += raw[k]
+            beg = offsets[start]
+
+            t = tok_of[start]
+            if des and t > 0 and doc[t][1] == beg and keys[t-1] in des:
+                prev_tok, prev_beg, prev_end = doc[t-1]
+                etype = des[keys[t-1]][0]
+                mention = '%s %s' % (prev_tok, mention)
+                beg = prev_beg
+
+            offset = '%s:%s-%s' % (docid, beg, offsets[end-1])
+            self.emit(mention, offset, etype, op, additional_info)
+
+
+class SNMatcher(Matcher):
+    # Hashtags and handles of social network posts, typed by the SN
+    # gazetteer when it has them (and dropped when it types them '-'), by
+    # default GPE and PER. With a fuzzy index, one missing from the
+    # gazetteer takes the etype of the closest entry within its distance;
+    # an approximate match never drops a name.
+    streams = ('sn',)
+    docids = 'SN_'
+    # first character -> (runid, qid prefix, default etype)
+    KINDS = {
+        '#': ('SN_HASH', 'SNHASH_', 'GPE'),
+        '@': ('SN_AT', 'SNAT_', 'PER'),
+    }
+
+    def __init__(self, gaz=None, fuzzy=None):
+        Matcher.__init__(self)
+        self.gaz = gaz
+        self.fuzzy = fuzzy
+
+    def fuzzy_entry(self, key):
+        hit = self.fuzzy.get(self.gaz, key)
+        if hit is None or self.gaz[hit[0]][0] == '-':
+            return None
+        return self.gaz[hit[0]]
+
+    def match(self, docid, doc, toks, keys):
+        gaz = self.gaz
+        res = self.res['sn']
+        for n, (tok, beg, end) in enumerate(doc):
+            kind = self.KINDS.get(tok[:1])
+            if kind is None:
+                continue
+            name = tok[1:]
+            if name.isdigit():
+                continue
+            if name.translate(PUNCT_TABLE) == '':
+                continue
+            if '#' in name or '@' in name:
+                continue
+            runid, prefix, etype = kind
+            additional_info = None
+            if gaz and keys[n] in gaz:
+                etype, op, additional_info = gaz[keys[n]]
+                if etype == '-':
+                    continue
+            elif gaz and self.fuzzy is not None:
+                entry = self.fuzzy_entry(keys[n])
+                if entry is not None:
+                    etype, op, additional_info = entry
+            offset = '%s:%s-%s' % (docid, beg, end)
+            qid = prefix + '{number:0{width}d}'.format(width=7,
+                                                       number=self.count)
+            res.append(TacTab(runid, qid, tok, offset, 'NIL', etype, 'NAM',
+                              '1.0', trans=additional_info))
+            self.count += 1
+
+
+# Each generator factory takes the loaded resources of add_names and
+# returns a matcher, or None when its resources are not loaded
+def generator_poster_author(resources, **kwargs):
+    if resources['psm'] is None:
+        return None
+    return PosterAuthorMatcher(resources['psm'])
+
+
+def generator_gazetteer(resources, mtype='NAM', **kwargs):
+    if resources['gaz'] is None:
+        return None
+    if resources['gaz_chars'] is not None:
+        return CharGazetteerMatcher(resources['gaz'], resources['gaz_chars'],
+                                    des=resources['des'], mtype=mtype)
+    return GazetteerMatcher(resources['gaz'], resources['gaz_tree'],
+                            des=resources['des'], mtype=mtype,
+                            fuzzy=resources['gaz_fuzzy'],
+                            lower=resources['vocab'] is not None)
+
+
+def generator_sn(resources, **kwargs):
+    return SNMatcher(resources['sn'], fuzzy=resources['sn_fuzzy'])
+
+
+GENERATORS = {
+    'poster_author': generator_poster_author,
+    'gazetteer': generator_gazetteer,
+    'sn': generator_sn,
+}
+GENERATOR_CHAIN = ['poster_author', 'gazetteer', 'sn']
+
+
+def build_matchers(resources, chain=GENERATOR_CHAIN, mtype='NAM'):
+    res = []
+    for name in chain:
+        matcher = GENERATORS[name](resources, mtype=mtype)
+        if matcher is not None:
+            res.append(matcher)
+    return res
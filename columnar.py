@@ -0,0 +1,257 @@
+import logging
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import util
+import decisions
+from util import TacTab
+
+
+logger = logging.getLogger()
+
+
+def available():
+    return np is not None
+
+
+class Interner(object):
+    # Dense int codes for strings, assigned in order of first appearance
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    def __len__(self):
+        return len(self.strings)
+
+    def code(self, s):
+        c = self.codes.get(s)
+        if c is None:
+            c = self.codes[s] = len(self.strings)
+            self.strings.append(s)
+        return c
+
+    def encode(self, seq):
+        return np.array([self.code(s) for s in seq], dtype=np.int32)
+
+
+class MentionColumns(object):
+    # Columnar form of a tab: docid, etype and mention as codes into
+    # interned tables, offsets as int arrays, and the remaining fields as
+    # interned codes or plain lists. Stores built with shared interners can
+    # be compared code to code. to_tab() rebuilds the exact tab lines.
+    def __init__(self, docids=None, etypes=None, mentions=None):
+        self.docids = docids if docids is not None else Interner()
+        self.etypes = etypes if etypes is not None else Interner()
+        self.mentions = mentions if mentions is not None else Interner()
+        self.fields = Interner()
+        self.doc = np.zeros(0, dtype=np.int32)
+        self.beg = np.zeros(0, dtype=np.int64)
+        self.end = np.zeros(0, dtype=np.int64)
+        self.etype = np.zeros(0, dtype=np.int32)
+        self.mention = np.zeros(0, dtype=np.int32)
+        # runid, kbid, mtype and conf codes into self.fields
+        self.meta = np.zeros((0, 4), dtype=np.int32)
+        self.qid = []
+        self.trans = []
+        # row -> offset string that '%s:%s-%s' would not reproduce
+        self.raw_offset = {}
+
+    def __len__(self):
+        return len(self.qid)
+
+    @classmethod
+    def from_tab(cls, tab, docids=None, etypes=None, mentions=None):
+        res = cls(docids=docids, etypes=etypes, mentions=mentions)
+        tab = list(tab)
+        res.doc = res.docids.encode(i.docid for i in tab)
+        res.beg = np.array([i.beg for i in tab], dtype=np.int64)
+        res.end = np.array([i.end for i in tab], dtype=np.int64)
+        res.etype = res.etypes.encode(i.etype for i in tab)
+        res.mention = res.mentions.encode(i.mention for i in tab)
+        code = res.fields.code
+        res.meta = np.array([(code(i.runid), code(i.kbid), code(i.mtype),
+                              code(i.conf)) for i in tab],
+                            dtype=np.int32).reshape(-1, 4)
+        res.qid = [i.qid for i in tab]
+        res.trans = [i.trans for i in tab]
+        for n, i in enumerate(tab):
+            if i.offset != '%s:%s-%s' % (i.docid, i.beg, i.end):
+                res.raw_offset[n] = i.offset
+        return res
+
+    @classmethod
+    def read(cls, ptab):
+        return cls.from_tab(util.iter_tab(ptab))
+
+    def row(self, n):
+        fields = self.fields.strings
+        runid, kbid, mtype, conf = self.meta[n]
+        offset = self.raw_offset.get(n)
+        if offset is None:
+            offset = '%s:%s-%s' % (self.docids.strings[self.doc[n]],
+                                   self.beg[n], self.end[n])
+        return TacTab(fields[runid], self.qid[n],
+                      self.mentions.strings[self.mention[n]], offset,
+                      fields[kbid], self.etypes.strings[self.etype[n]],
+                      fields[mtype], fields[conf], trans=self.trans[n])
+
+    def to_tab(self):
+        return [self.row(n) for n in range(len(self))]
+
+    def write(self, outpath):
+        with open(outpath, 'w') as fw:
+            fw.write('\n'.join([str(i) for i in self.to_tab()]))
+
+    def doc_keys(self, shift):
+        # Offsets of every document moved into their own range of `shift`
+        # positions, so one sorted array covers the whole corpus
+        base = self.doc.astype(np.int64) * shift
+        return base + self.beg, base + self.end
+
+
+def expand_ranges(lo, hi):
+    # For ranges [lo[k], hi[k]) returns (k, position) of every element
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(lo)), counts)
+    starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    return owner, starts + np.arange(counts.sum())
+
+
+def group_by_doc(tab):
+    # Same grouping as util.get_tab_in_doc_level
+    tab = list(tab)
+    res = {}
+    if not tab:
+        return res
+    cols = MentionColumns.from_tab(tab)
+    order = np.argsort(cols.doc, kind='stable')
+    bounds = np.flatnonzero(np.diff(cols.doc[order])) + 1
+    for rows in np.split(order, bounds):
+        res[cols.docids.strings[cols.doc[rows[0]]]] = [tab[n] for n in rows]
+    return res
+
+
+def overlap_groups(tab):
+    # Groups of transitively overlapping mentions over the whole tab in one
+    # sweep, yielding the groups of interval.overlap_groups document by
+    # document in tab order
+    tab = list(tab)
+    if not tab:
+        return
+    cols = MentionColumns.from_tab(tab)
+    shift = int(cols.end.max()) + 2
+    beg, end = cols.doc_keys(shift)
+    order = np.lexsort((end, beg))
+    reach = np.maximum.accumulate(end[order])
+    bounds = np.flatnonzero(beg[order][1:] > reach[:-1]) + 1
+    for rows in np.split(order, bounds):
+        yield [tab[n] for n in rows]
+
+
+def duo_overlaps(tab, tab_to_add):
+    # Pairs the mentions to add with the mentions of tab they conflict
+    # with, exactly as the loop in add_names.check_conflicts_duo_tab:
+    # returns (duplicate pairs, overlapped pairs, non overlapped mentions).
+    # For each mention, tab is scanned in order and stops at the first
+    # mention with the same offsets.
+    tab = list(tab)
+    tab_to_add = list(tab_to_add)
+    if not tab or not tab_to_add:
+        return [], [], tab_to_add
+    docids = Interner()
+    a = MentionColumns.from_tab(tab, docids=docids)
+    b = MentionColumns.from_tab(tab_to_add, docids=docids)
+    shift = int(max(a.end.max(), b.end.max())) + 2
+    a_beg, a_end = a.doc_keys(shift)
+    b_beg, b_end = b.doc_keys(shift)
+
+    order = np.argsort(a_beg, kind='stable')
+    sorted_beg = a_beg[order]
+    # the window reaches back by the longest mention of the same document,
+    # as in interval.MentionIndex, so one long mention elsewhere does not
+    # widen every lookup
+    maxlen = np.zeros(len(docids), dtype=np.int64)
+    np.maximum.at(maxlen, a.doc, a.end - a.beg)
+    lo = np.searchsorted(sorted_beg, b_beg - maxlen[b.doc], 'left')
+    # a reversed span (end < beg) has no candidates
+    hi = np.maximum(np.searchsorted(sorted_beg, b_end, 'right'), lo)
+    ii, pos = expand_ranges(lo, hi)
+    jj = order[pos]
+
+    dup = (a_beg[jj] == b_beg[ii]) & (a_end[jj] == b_end[ii])
+    ov = np.maximum(a_beg[jj], b_beg[ii]) < np.minimum(a_end[jj], b_end[ii])
+    first_dup = np.full(len(b), len(a), dtype=np.int64)
+    np.minimum.at(first_dup, ii[dup], jj[dup])
+    keep = ov & ~dup & (jj < first_dup[ii])
+    ii = ii[keep]
+    jj = jj[keep]
+    pairs = np.lexsort((jj, ii))
+
+    duplicate_tab = [(tab_to_add[i], tab[first_dup[i]])
+                     for i in np.flatnonzero(first_dup < len(a))]
+    overlapped_tab = [(tab_to_add[i], tab[j])
+                      for i, j in zip(ii[pairs], jj[pairs])]
+    conflicted = first_dup < len(a)
+    conflicted[ii] = True
+    non_overlapped_tab = [tab_to_add[i] for i in np.flatnonzero(~conflicted)]
+    return duplicate_tab, overlapped_tab, non_overlapped_tab
+
+
+# Whole-tab versions of remove_names filters. Each takes the columns and
+# the run configuration and returns a mask of the rows it removes.
+def mask_digits(cols, psm=None, **kwargs):
+    is_digits = np.array([m.isdigit() for m in cols.mentions.strings],
+                         dtype=bool)
+    is_sn = np.array(['SN_' in d for d in cols.docids.strings], dtype=bool)
+    mask = is_digits[cols.mention] & ~is_sn[cols.doc]
+    if psm:
+        for n in np.flatnonzero(mask):
+            docid = cols.docids.strings[cols.doc[n]]
+            if docid in psm and \
+               cols.mentions.strings[cols.mention[n]] in psm[docid]:
+                mask[n] = False
+    return mask
+
+
+def mask_long_name(cols, long_name_thres=None, **kwargs):
+    n_toks = np.array([len(m.split()) for m in cols.mentions.strings],
+                      dtype=np.int64)
+    return n_toks[cols.mention] >= long_name_thres
+
+
+MASKS = {
+    'digits': mask_digits,
+    'long_name': mask_long_name,
+}
+
+
+def filter_tab(tab, filters, **kwargs):
+    # remove_names.filter_tab over (name, filter) pairs. Filters with a
+    # mask run over the interned mention table and the whole tab at once;
+    # the others run on each remaining name. A name is charged to the first
+    # filter that removes it.
+    tab = list(tab)
+    histories = defaultdict(int)
+    if not tab:
+        return [], histories
+    cols = MentionColumns.from_tab(tab)
+    alive = np.ones(len(tab), dtype=bool)
+    log = decisions.active()
+    for name, f in filters:
+        if name in MASKS:
+            rows = np.flatnonzero(alive & MASKS[name](cols, **kwargs))
+            removed = [(n, f(tab[n])) for n in rows]
+        else:
+            removed = [(n, f(tab[n])) for n in np.flatnonzero(alive)]
+            removed = [(n, reason) for n, reason in removed if reason]
+        for n, reason in removed:
+            i = tab[n]
+            alive[n] = False
+            histories[(reason, i.mention, i.etype)] += 1
+            if log:
+                log.record('remove', reason, i, old=i.etype)
+    return [tab[n] for n in np.flatnonzero(alive)], histories
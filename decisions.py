@@ -0,0 +1,162 @@
+import os
+import sys
+import shutil
+import json
+import zlib
+import marshal
+import logging
+import argparse
+from collections import defaultdict
+
+
+logger = logging.getLogger()
+
+# A decision is a tuple of these fields: the stage that made it, a reason
+# code, the name it is about, its etype before and after, and the input
+# the name came from when a stage reads several (None otherwise)
+FIELDS = ('stage', 'reason', 'qid', 'offset', 'mention', 'old', 'new',
+          'source')
+FORMATS = ['jsonl', 'marshal']
+
+# The open log, None while decisions are not logged
+_log = None
+
+
+class DecisionLog(object):
+    # Streams decision records to a file, one JSON object per line or one
+    # marshal record after another. With sample < 1 only decisions
+    # about that fraction of names are kept; names are picked by a hash of
+    # their offset, so a sampled name keeps its decisions from every stage
+    # and every worker.
+    def __init__(self, path, fmt='jsonl', sample=1.0):
+        self.path = path
+        self.fmt = fmt
+        self.sample = sample
+        self.threshold = int(sample * 0xffffffff)
+        self.count = 0
+        self.fw = self.open(path, 'w')
+
+    def open(self, path, mode):
+        if self.fmt == 'marshal':
+            return open(path, mode + 'b')
+        return open(path, mode, encoding='utf-8')
+
+    def record(self, stage, reason, mention, old=None, new=None,
+               source=None):
+        if self.sample < 1 and \
+           zlib.crc32(mention.offset.encode('utf-8')) > self.threshold:
+            return
+        rec = (stage, reason, mention.qid, mention.offset, mention.mention,
+               old, new, source)
+        if self.fmt == 'marshal':
+            marshal.dump(rec, self.fw)
+        else:
+            self.fw.write(json.dumps(dict(zip(FIELDS, rec)),
+                                     ensure_ascii=False))
+            self.fw.write('\n')
+        self.count += 1
+
+    def part_path(self, k):
+        return '%s.part%s' % (self.path, k)
+
+    def close(self):
+        self.fw.close()
+        logger.info('%s decisions written to %s' % (self.count, self.path))
+
+
+def enable(path, fmt='jsonl', sample=1.0):
+    global _log
+    disable()
+    _log = DecisionLog(path, fmt=fmt, sample=sample)
+    return _log
+
+
+def disable():
+    global _log
+    if _log is not None:
+        _log.close()
+    _log = None
+
+
+def active():
+    # The open log or None. Callers fetch it once per stage and only build
+    # records when it is set.
+    return _log
+
+
+def flush():
+    # Call before forking workers, so they do not inherit buffered records
+    if _log is not None:
+        _log.fw.flush()
+
+
+def start_shard(k):
+    # In a forked worker: write to a part file of its own
+    if _log is None:
+        return
+    _log.fw.close()
+    _log.fw = _log.open(_log.part_path(k), 'w')
+    _log.count = 0
+
+
+def end_shard():
+    if _log is None:
+        return 0
+    _log.fw.close()
+    return _log.count
+
+
+def join_shards(n_shards, counts=()):
+    # In the parent: append the part files of the workers in shard order
+    if _log is None:
+        return
+    _log.count += sum(counts)
+    for k in range(n_shards):
+        path = _log.part_path(k)
+        if not os.path.exists(path):
+            continue
+        with _log.open(path, 'r') as f:
+            shutil.copyfileobj(f, _log.fw)
+        os.remove(path)
+
+
+def iter_records(path, fmt='jsonl'):
+    if fmt == 'marshal':
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield marshal.load(f)
+                except EOFError:
+                    return
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                rec = json.loads(line)
+                yield tuple(rec.get(i) for i in FIELDS)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help='path to a decision log')
+    parser.add_argument('--format', type=str, choices=FORMATS,
+                        default='jsonl', help='format of the log')
+    parser.add_argument('--stage', type=str, help='only this stage')
+    parser.add_argument('--reason', type=str, help='only this reason')
+    parser.add_argument('--summary', action='store_true', default=False,
+                        help='count decisions per stage and reason')
+    args = parser.parse_args()
+
+    count = defaultdict(int)
+    for rec in iter_records(args.path, fmt=args.format):
+        if args.stage and rec[0] != args.stage:
+            continue
+        if args.reason and rec[1] != args.reason:
+            continue
+        if args.summary:
+            count[rec[:2]] += 1
+        else:
+            sys.stdout.write(json.dumps(dict(zip(FIELDS, rec)),
+                                        ensure_ascii=False) + '\n')
+    for (stage, reason), c in sorted(count.items()):
+        print('%s\t%s\t%s' % (stage, reason, c))
@@ -0,0 +1,244 @@
+import os
+import heapq
+import logging
+import argparse
+from collections import defaultdict
+
+import util
+import interval
+import decisions
+import instrument
+
+
+logger = logging.getLogger()
+
+# How the spans of an overlap group are ranked; the greedy selection keeps
+# the best span of each conflict.
+#   priority: spans of the earlier system win, more votes break ties
+#   vote: spans with more (weighted) votes win, the earlier system breaks
+#         ties
+POLICIES = ['priority', 'vote']
+
+
+def tab_key(i):
+    return i.docid, i.beg, i.end
+
+
+def iter_sorted_tab(ptab, source):
+    # Yields (docid, beg, end, source, lineno, TacTab) of a tab sorted by
+    # docid and offsets, the order heapq.merge() needs
+    prev = None
+    for n, i in enumerate(util.iter_tab(ptab)):
+        key = tab_key(i)
+        if prev is not None and key < prev:
+            raise ValueError('%s: line %s is out of docid/offset order, '
+                             'sort the tab or use --sort' % (ptab, n + 1))
+        prev = key
+        yield key + (source, n, i)
+
+
+def iter_unsorted_tab(ptab, source):
+    # iter_sorted_tab() of a tab in any order, sorted in memory
+    tab = sorted(util.iter_tab(ptab), key=tab_key)
+    for n, i in enumerate(tab):
+        yield tab_key(i) + (source, n, i)
+
+
+def iter_groups(merged):
+    # Groups of transitively overlapping mentions of a stream sorted by
+    # docid and offsets, as interval.overlap_groups() without holding more
+    # than one group. Items are (source, TacTab).
+    group = []
+    group_doc = None
+    group_end = None
+    for docid, beg, end, source, n, i in merged:
+        if group and (docid != group_doc or beg > group_end):
+            yield group
+            group = []
+        if not group or end > group_end:
+            group_doc = docid
+            group_end = end
+        group.append((source, i))
+    if group:
+        yield group
+
+
+class Span(object):
+    # The mentions systems proposed for one offset, with the etype they
+    # vote for and the rank used to resolve conflicts. mentions holds the
+    # mention of each system in sources.
+    __slots__ = ('mention', 'beg', 'end', 'sources', 'mentions', 'votes',
+                 'etype', 'etypes')
+
+    def __init__(self, mention):
+        self.mention = mention
+        self.beg = mention.beg
+        self.end = mention.end
+        self.sources = []
+        self.mentions = []
+        self.votes = 0
+        self.etype = mention.etype
+        self.etypes = {}
+
+    def vote(self, source, mention, weight):
+        # One vote per system. The etype is the weighted majority so far,
+        # the earliest system's on ties, as systems vote in order.
+        if source in self.sources:
+            return
+        etype = mention.etype
+        self.sources.append(source)
+        self.mentions.append(mention)
+        self.votes += weight
+        n = self.etypes.get(etype, 0) + weight
+        self.etypes[etype] = n
+        if n > self.etypes[self.etype]:
+            self.etype = etype
+
+
+def vote_spans(group, weights):
+    # Spans of a group, one per offset, with the mention of the earliest
+    # system proposing it. Mentions of one offset come in system order.
+    spans = {}
+    for source, i in group:
+        span = spans.get(i.offset)
+        if span is None:
+            span = spans[i.offset] = Span(i)
+        span.vote(source, i, weights[source])
+    return list(spans.values())
+
+
+def policy_key(policy):
+    # longer spans, then earlier ones, win the remaining ties
+    if policy == 'priority':
+        return lambda x: (min(x.sources), -x.votes, x.beg - x.end, x.beg)
+    if policy == 'vote':
+        return lambda x: (-x.votes, min(x.sources), x.beg - x.end, x.beg)
+    raise ValueError('unknown policy: %s' % policy)
+
+
+def log_group(log, spans, kept, ptabs, min_votes):
+    # One decision per system line: qids repeat across systems, so each
+    # record names the tab its line came from
+    kept_ids = set(id(i) for i in kept)
+    for span in spans:
+        if span.votes < min_votes:
+            reason = 'outvoted'
+        elif id(span) not in kept_ids:
+            reason = 'overlapped'
+        else:
+            reason = None
+        for source, i in zip(span.sources, span.mentions):
+            if reason:
+                log.record('ensemble', reason, i, old=i.etype,
+                           source=ptabs[source])
+            elif i.etype != span.etype:
+                log.record('ensemble', 'etype_vote', i, old=i.etype,
+                           new=span.etype, source=ptabs[source])
+
+
+def merge(ptabs, policy='vote', weights=None, min_votes=1, presorted=True):
+    # k-way merge of the tabs of several systems, each sorted by docid and
+    # offsets. Mentions of the same offset are one span voted for by the
+    # systems proposing it; spans with less than min_votes are dropped and
+    # of overlapping spans the best by policy are kept. Yields the kept
+    # mentions in docid and offset order, holding one overlap group at a
+    # time. weights, one per tab, default to 1; earlier tabs have priority.
+    if weights is None:
+        weights = [1.0] * len(ptabs)
+    if len(weights) != len(ptabs):
+        raise ValueError('%s weights for %s tabs' %
+                         (len(weights), len(ptabs)))
+    read = iter_sorted_tab if presorted else iter_unsorted_tab
+    merged = heapq.merge(*[read(p, k) for k, p in enumerate(ptabs)])
+    key = policy_key(policy)
+    log = decisions.active()
+    for group in iter_groups(merged):
+        spans = vote_spans(group, weights)
+        voted = [i for i in spans if i.votes >= min_votes]
+        if len(voted) > 1:
+            kept = interval.select_non_overlapping(voted, key=key)
+        else:
+            kept = voted
+        if log:
+            log_group(log, spans, kept, ptabs, min_votes)
+        for span in sorted(kept, key=lambda x: (x.beg, x.end)):
+            span.mention.etype = span.etype
+            yield span.mention
+
+
+def process(ptabs, outpath, policy='vote', weights=None, min_votes=1,
+            presorted=True, runid='RPI_BLENDER'):
+    # Writes the merge() of ptabs to outpath with fresh ids. The names go
+    # to a temporary file renamed once every input has been read, so an
+    # input out of order leaves no partial output behind.
+    logger.info('------ MERGING %s TABS (%s) ------' % (len(ptabs), policy))
+    count = defaultdict(int)
+    n = 0
+    tmp = '%s.%s.tmp' % (outpath, os.getpid())
+    try:
+        with instrument.stage('ensemble') as st, open(tmp, 'w') as fw:
+            for i in merge(ptabs, policy=policy, weights=weights,
+                           min_votes=min_votes, presorted=presorted):
+                i.runid = runid
+                i.qid = 'M_' + '{number:0{width}d}'.format(width=7,
+                                                         number=n)
+                if n:
+                    fw.write('\n')
+                fw.write(str(i))
+                count[i.etype] += 1
+                n += 1
+            st.count(mentions=n)
+        os.replace(tmp, outpath)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    logger.info('total names: %s' % n)
+    for i in count:
+        logger.info('%s %s' % (i, count[i]))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
+    logging.root.setLevel(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outpath', type=str, help='output path')
+    parser.add_argument('ptabs', type=str, nargs='+',
+                        help='paths to the tabs of each system, by priority')
+    parser.add_argument('--policy', type=str, choices=POLICIES,
+                        default='vote',
+                        help='how conflicts between overlapping names are '
+                        'resolved')
+    parser.add_argument('--weights', type=float, nargs='+',
+                        help='vote weight of each tab, 1 by default')
+    parser.add_argument('--min-votes', type=float, default=1,
+                        help='drop names with fewer (weighted) votes')
+    parser.add_argument('--sort', action='store_true', default=False,
+                        help='sort each tab in memory first; tabs must be '
+                        'sorted by docid and offsets otherwise')
+    parser.add_argument('--runid', type=str, default='RPI_BLENDER',
+                        help='run id of the merged tab')
+    parser.add_argument('--report', type=str,
+                        help='path of a JSON report of timing and memory')
+    parser.add_argument('--decisions', type=str,
+                        help='path of a log of every dropped name and etype '
+                        'vote')
+    args = parser.parse_args()
+    if args.weights and len(args.weights) != len(args.ptabs):
+        parser.error('give one weight per tab')
+    if args.report:
+        instrument.enable()
+    if args.decisions:
+        decisions.enable(args.decisions)
+
+    try:
+        process(args.ptabs, args.outpath, policy=args.policy,
+                weights=args.weights, min_votes=args.min_votes,
+                presorted=not args.sort, runid=args.runid)
+    except ValueError as e:
+        parser.error(str(e))
+
+    decisions.disable()
+    if args.report:
+        instrument.write_report(args.report)
+    logger.info('done.\n')
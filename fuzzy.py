@@ -0,0 +1,123 @@
+import logging
+from collections import defaultdict
+
+
+logger = logging.getLogger()
+
+
+def deletes(s, k):
+    # Every string made by deleting up to k characters of s, s included
+    res = {s}
+    frontier = {s}
+    for _ in range(k):
+        frontier = set(w[:n] + w[n+1:] for w in frontier
+                       for n in range(len(w)))
+        res |= frontier
+    return res
+
+
+def distance(a, b, k):
+    # Optimal string alignment distance of a and b (edits and adjacent
+    # transpositions), or k + 1 as soon as it must be over k
+    if abs(len(a) - len(b)) > k:
+        return k + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            d = min(prev[j] + 1, cur[j-1] + 1,
+                    prev[j-1] + (a[i-1] != b[j-1]))
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                d = min(d, prev2[j-2] + 1)
+            cur[j] = d
+        if min(cur) > k:
+            return k + 1
+        prev2, prev = prev, cur
+    return min(prev[-1], k + 1)
+
+
+class FuzzyIndex(object):
+    # SymSpell-style index of the tokens of a gazetteer: each token is
+    # stored under every string made by deleting up to k of its characters.
+    # Two tokens within edit distance k share one of those strings, so a
+    # lookup only generates the deletes of the query and verifies the few
+    # tokens they hit, whatever the size of the gazetteer. Tokens shorter
+    # than min_len are neither indexed nor looked up. Only documents whose
+    # ids mark noisy text are matched approximately.
+    NOISY_DOCS = ['SN_', 'DF_']
+
+    def __init__(self, gaz, k=1, min_len=4, cache_size=1 << 16):
+        self.k = k
+        self.min_len = min_len
+        self.cache_size = cache_size
+        self._cache = {}
+        index = defaultdict(list)
+        tokens = set(tok for mention in gaz for tok in mention.split(' '))
+        for tok in sorted(tokens):
+            if len(tok) < min_len:
+                continue
+            for d in deletes(tok, k):
+                index[d].append(tok)
+        self.index = dict(index)
+        logger.info('fuzzy index: %s tokens under %s deletes, k=%s' %
+                    (len(tokens), len(self.index), k))
+
+    def is_noisy(self, docid):
+        return any(i in docid for i in self.NOISY_DOCS)
+
+    def lookup(self, tok):
+        # [(token, distance)] of indexed tokens within k of tok other than
+        # tok itself, closest first
+        res = self._cache.get(tok)
+        if res is not None:
+            return res
+        res = []
+        if len(tok) >= self.min_len:
+            found = set()
+            for d in deletes(tok, self.k):
+                found.update(self.index.get(d, ()))
+            found.discard(tok)
+            for i in found:
+                dist = distance(tok, i, self.k)
+                if dist <= self.k:
+                    res.append((i, dist))
+            res.sort(key=lambda x: (x[1], x[0]))
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[tok] = res
+        return res
+
+    def walk(self, trie, seq, start):
+        # Longest path of the gazetteer trie from seq[start] that ends on an
+        # entry, where each token may be swapped for an indexed one and the
+        # distances add up to 1..k. Returns (state, end, distance) or None;
+        # paths matching exactly are left to trie.walk().
+        best = None
+        beam = {0: 0}
+        end = start
+        while beam and end < len(seq):
+            alts = [(seq[end], 0)] + self.lookup(seq[end])
+            nxt = {}
+            for state, dist in beam.items():
+                for sym, d in alts:
+                    if dist + d > self.k:
+                        break
+                    s = trie.step(state, sym)
+                    if s is not None and dist + d < nxt.get(s, self.k + 1):
+                        nxt[s] = dist + d
+            beam = nxt
+            end += 1
+            for state, dist in beam.items():
+                if dist and state in trie.value and \
+                   (best is None or best[1] < end or dist < best[2]):
+                    best = (state, end, dist)
+        return best
+
+    def get(self, gaz, mention):
+        # (entry, distance) of the closest single-token entry of gaz within
+        # k of mention, or None
+        for i, dist in self.lookup(mention):
+            if i in gaz:
+                return i, dist
+        return None
@@ -0,0 +1,266 @@
+import functools
+from array import array
+from bisect import bisect_left
+
+import util
+from automaton import Trie
+
+
+class StringPool(object):
+    # Strings packed into one UTF-8 buffer, string n being
+    # data[offsets[n]:offsets[n+1]]. find() needs the strings sorted.
+    def __init__(self, strings=()):
+        data = bytearray()
+        self.offsets = array('q', [0])
+        for s in strings:
+            data += s.encode('utf-8')
+            self.offsets.append(len(data))
+        self.data = bytes(data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        return self.data[self.offsets[n]:self.offsets[n+1]].decode('utf-8')
+
+    def find(self, s):
+        # Index of s, or -1. UTF-8 byte order is code point order, so a
+        # pool built from sorted strings is sorted bytewise.
+        key = s.encode('utf-8')
+        data = self.data
+        offsets = self.offsets
+        lo = 0
+        hi = len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offsets[mid]:offsets[mid+1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(offsets) - 1 and data[offsets[lo]:offsets[lo+1]] == key:
+            return lo
+        return -1
+
+    def dump(self):
+        return self.data, self.offsets.tobytes()
+
+    @classmethod
+    def load(cls, payload):
+        res = cls()
+        res.data, offsets = payload
+        res.offsets = array('q')
+        res.offsets.frombytes(offsets)
+        return res
+
+
+class StateValues(object):
+    # The Trie.value interface of a CompactGaz: state -> mention
+    def __init__(self, gaz):
+        self.gaz = gaz
+
+    def get(self, state, default=None):
+        if self.gaz.entry[state] < 0:
+            return default
+        return self.gaz.mention(state)
+
+    def __contains__(self, state):
+        return self.gaz.entry[state] >= 0
+
+
+class CompactGaz(object):
+    # Read-only gazetteer over flat arrays instead of Python objects. It is
+    # both the mention -> (etype, op, additional_info) mapping of
+    # util.read_gaz and the token trie of util.build_gaz_trie:
+    # - tokens are interned into a sorted string pool,
+    # - trie states are numbered breadth first, so the children of a
+    #   state are one run of child_tok/child_state sorted by token, found
+    #   from child_start,
+    # - a state ending an entry points into the etype/op code arrays and
+    #   the additional info pool,
+    # - mentions are not stored: a state's mention is spelled by walking
+    #   parent links back to the root.
+    ARRAYS = ['child_start', 'child_tok', 'child_state', 'parent',
+              'parent_tok', 'entry', 'etype', 'op', 'info']
+
+    def __init__(self):
+        self.tokens = StringPool()
+        self.infos = StringPool()
+        self.etypes = []
+        self.ops = []
+        self.child_start = array('i', [0, 0])
+        self.child_tok = array('i')
+        self.child_state = array('i')
+        self.parent = array('i', [-1])
+        self.parent_tok = array('i', [-1])
+        self.entry = array('i', [-1])
+        self.etype = array('b')
+        self.op = array('b')
+        self.info = array('i')
+        self.value = StateValues(self)
+        self._init_lookup()
+
+    def _init_lookup(self):
+        # documents repeat their tokens, so remember recent lookups
+        self.tok_id = functools.lru_cache(maxsize=1 << 16)(self.tokens.find)
+
+    @classmethod
+    def build(cls, gaz):
+        res = cls()
+        toks = sorted(set(tok for mention in gaz
+                          for tok in mention.split(' ')))
+        res.tokens = StringPool(toks)
+        tok_id = {tok: n for n, tok in enumerate(toks)}
+        del toks
+        infos = sorted(set(i[2] for i in gaz.values() if i[2] is not None))
+        res.infos = StringPool(infos)
+        info_id = {s: n for n, s in enumerate(infos)}
+        res.etypes = sorted(set(i[0] for i in gaz.values()))
+        res.ops = sorted(set(i[1] for i in gaz.values()))
+        etype_id = {s: n for n, s in enumerate(res.etypes)}
+        op_id = {s: n for n, s in enumerate(res.ops)}
+
+        trie = Trie()
+        for mention, (etype, op, info) in gaz.items():
+            trie.add([tok_id[tok] for tok in mention.split(' ')],
+                     (etype_id[etype], op_id[op],
+                      -1 if info is None else info_id[info]))
+        del tok_id, info_id
+
+        # renumber breadth first
+        res.child_start = array('i', [0])
+        order = [0]
+        new = {0: 0}
+        for state in order:
+            goto = trie.goto[state]
+            for tok in sorted(goto):
+                nxt = goto[tok]
+                new[nxt] = len(order)
+                order.append(nxt)
+                res.child_tok.append(tok)
+                res.child_state.append(new[nxt])
+                res.parent.append(new[state])
+                res.parent_tok.append(tok)
+            res.child_start.append(len(res.child_tok))
+        res.entry = array('i', [-1]) * len(order)
+        for state, (etype, op, info) in trie.value.items():
+            res.entry[new[state]] = len(res.etype)
+            res.etype.append(etype)
+            res.op.append(op)
+            res.info.append(info)
+        res._init_lookup()
+        return res
+
+    def dump(self):
+        # Plain bytes and lists, for marshal
+        return {
+            'tokens': self.tokens.dump(),
+            'infos': self.infos.dump(),
+            'etypes': self.etypes,
+            'ops': self.ops,
+            'arrays': {name: (getattr(self, name).typecode,
+                              getattr(self, name).tobytes())
+                       for name in self.ARRAYS},
+        }
+
+    @classmethod
+    def load(cls, payload):
+        res = cls()
+        res.tokens = StringPool.load(payload['tokens'])
+        res.infos = StringPool.load(payload['infos'])
+        res.etypes = payload['etypes']
+        res.ops = payload['ops']
+        for name, (typecode, data) in payload['arrays'].items():
+            values = array(typecode)
+            values.frombytes(data)
+            setattr(res, name, values)
+        res._init_lookup()
+        return res
+
+    def walk(self, seq, start=0):
+        # Same as Trie.walk over the token sequence
+        tok_id = self.tok_id
+        child_start = self.child_start
+        child_tok = self.child_tok
+        child_state = self.child_state
+        state = 0
+        end = start
+        n = len(seq)
+        while end < n:
+            tok = tok_id(seq[end])
+            if tok < 0:
+                break
+            lo = child_start[state]
+            hi = child_start[state+1]
+            k = bisect_left(child_tok, tok, lo, hi)
+            if k == hi or child_tok[k] != tok:
+                break
+            state = child_state[k]
+            end += 1
+        return state, end
+
+    def step(self, state, sym):
+        # Same as Trie.step
+        tok = self.tok_id(sym)
+        if tok < 0:
+            return None
+        lo = self.child_start[state]
+        hi = self.child_start[state+1]
+        k = bisect_left(self.child_tok, tok, lo, hi)
+        if k == hi or self.child_tok[k] != tok:
+            return None
+        return self.child_state[k]
+
+    def state(self, mention):
+        # Trie state of mention if it is an entry, else -1
+        toks = mention.split(' ')
+        state, end = self.walk(toks)
+        if end != len(toks) or self.entry[state] < 0:
+            return -1
+        return state
+
+    def mention(self, state):
+        toks = []
+        while state > 0:
+            toks.append(self.tokens[self.parent_tok[state]])
+            state = self.parent[state]
+        return ' '.join(reversed(toks))
+
+    def entry_of(self, state):
+        n = self.entry[state]
+        info = self.info[n]
+        return (self.etypes[self.etype[n]], self.ops[self.op[n]],
+                None if info < 0 else self.infos[info])
+
+    def __len__(self):
+        return len(self.etype)
+
+    def __contains__(self, mention):
+        return self.state(mention) >= 0
+
+    def __getitem__(self, mention):
+        state = self.state(mention)
+        if state < 0:
+            raise KeyError(mention)
+        return self.entry_of(state)
+
+    def get(self, mention, default=None):
+        state = self.state(mention)
+        if state < 0:
+            return default
+        return self.entry_of(state)
+
+    def __iter__(self):
+        for state in range(len(self.entry)):
+            if self.entry[state] >= 0:
+                yield self.mention(state)
+
+    def items(self):
+        for state in range(len(self.entry)):
+            if self.entry[state] >= 0:
+                yield self.mention(state), self.entry_of(state)
+
+
+def read_gaz(pgaz, lower=False):
+    # util.read_gaz returning one CompactGaz as both mapping and trie
+    res = CompactGaz.build(util.read_gaz_entries(pgaz, lower=lower))
+    return res, res
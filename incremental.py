@@ -0,0 +1,216 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+from collections import defaultdict
+
+import util
+import cache
+import parallel
+import add_names
+import instrument
+import remove_names
+import rule
+
+
+logger = logging.getLogger()
+
+# Bump whenever a change to the pipeline changes its output
+MANIFEST_VERSION = 4
+
+
+def fingerprint(paths, opts):
+    # Digest of everything besides a document's own content that its
+    # output depends on: resource files, options and the pipeline version
+    h = hashlib.sha1(('%s\t%s' % (MANIFEST_VERSION,
+                                  sorted(opts.items()))).encode('utf-8'))
+    for name, path in sorted(paths.items()):
+        digest = cache.file_digest(path) if path else None
+        h.update(('\t%s=%s' % (name, digest)).encode('utf-8'))
+    return h.hexdigest()
+
+
+class Manifest(object):
+    # Per-document content hashes and output of the last run, stored as a
+    # cache.py artifact. docs maps docid -> (hash, [(key, line)]) with keys
+    # relative to the document: (0, n) for its n-th line of the tab and
+    # (segment, position) for added names. ids maps every output name to
+    # the number reassign_id gave it.
+    def __init__(self, path):
+        self.path = path
+        self.fingerprint = None
+        self.docs = {}
+        self.ids = {}
+        self.next_id = 0
+        artifact = cache.read_artifact(path)
+        if artifact is None or artifact[1] is None:
+            return
+        header, payload = artifact
+        if header['kind'] != 'manifest':
+            return
+        self.fingerprint = header['fingerprint']
+        self.docs = payload['docs']
+        self.ids = payload['ids']
+        self.next_id = payload['next_id']
+
+    def save(self):
+        header = {
+            'version': cache.CACHE_VERSION,
+            'kind': 'manifest',
+            'fingerprint': self.fingerprint,
+        }
+        payload = {
+            'docs': self.docs,
+            'ids': self.ids,
+            'next_id': self.next_id,
+        }
+        cache.write_artifact(self.path, header, payload)
+        logger.info('manifest written to %s' % self.path)
+
+    def assign_ids(self, tab):
+        # Numbers for reassign_id. A name of the last run keeps its number,
+        # new names take numbers never handed out before.
+        ids = {}
+        seen = defaultdict(int)
+        res = []
+        for i in tab:
+            key = '%s\t%s' % (i.offset, i.mention)
+            n = seen[key]
+            seen[key] += 1
+            key = '%s\t%s' % (key, n)
+            number = self.ids.get(key)
+            if number is None:
+                number = self.next_id
+                self.next_id += 1
+            ids[key] = number
+            res.append(number)
+        self.ids = ids
+        return res
+
+
+def read_tab_by_doc(ptab):
+    # docid -> [(lineno, line)] in tab order
+    res = defaultdict(list)
+    with open(ptab, 'r') as f:
+        for n, line in enumerate(f):
+            docid = util.parse_offset(line.split('\t')[3])[0]
+            res[docid].append((n, line))
+    return res
+
+
+def doc_hash(doc, lines):
+    h = hashlib.sha1()
+    for tok, beg, end in doc:
+        h.update(('%s %s %s\n' % (tok, beg, end)).encode('utf-8'))
+    h.update(b'\0')
+    for n, line in lines:
+        h.update(line.encode('utf-8'))
+    return h.hexdigest()
+
+
+def scan(pbio, tab_doc, manifest, outdir):
+    # Hashes every document and copies the changed ones to a BIO file in
+    # outdir. Returns (docid -> BIO rank, docid -> hash, dirty docids, path)
+    ranks = {}
+    hashes = {}
+    dirty = set()
+    reuse = manifest.docs
+    pdirty = os.path.join(outdir, 'dirty.bio')
+    with open(pdirty, 'w') as fw:
+        for docid, doc in util.iter_bio(pbio, compact=True):
+            ranks[docid] = len(ranks)
+            hashes[docid] = doc_hash(doc, tab_doc.get(docid, ()))
+            if docid in reuse and reuse[docid][0] == hashes[docid]:
+                continue
+            dirty.add(docid)
+            for tok, beg, end in doc:
+                fw.write('%s %s:%s-%s\n' % (tok, docid, beg, end))
+            fw.write('\n')
+    for docid, lines in tab_doc.items():
+        if docid in hashes:
+            continue
+        hashes[docid] = doc_hash((), lines)
+        if docid not in reuse or reuse[docid][0] != hashes[docid]:
+            dirty.add(docid)
+    return ranks, hashes, dirty, pdirty
+
+
+def process(pbio, ptab, pmanifest, lower=False, lang=None, ppsm=None,
+            pgaz=None, psn=None, pdes=None, prule=None, sn=True,
+            mtype='NAM', cache_dir=None, columns=False, compact=False,
+            fuzzy=0, matcher=None):
+    # Reruns the pipeline only on documents whose BIO tokens or tab lines
+    # changed since the run recorded in pmanifest, and splices the recorded
+    # output of the other documents back in serial order. Any change to the
+    # resources or options reruns everything. Returns (tab, manifest); save
+    # the manifest once the output is written.
+    manifest = Manifest(pmanifest)
+    paths = {'psm': ppsm, 'gaz': pgaz, 'sn': psn, 'des': pdes, 'rule': prule}
+    opts = {'lower': lower, 'lang': lang, 'sn': sn, 'mtype': mtype,
+            'fuzzy': fuzzy,
+            'matcher': add_names.gaz_matcher(lang, matcher)}
+    fp = fingerprint(paths, opts)
+    if manifest.fingerprint != fp:
+        if manifest.docs:
+            logger.info('resources or options changed, rerunning all docs')
+        manifest.fingerprint = fp
+        manifest.docs = {}
+
+    resources, filters, rule_index = parallel.load(
+        lower=lower, lang=lang, ppsm=ppsm, pgaz=pgaz, psn=psn, pdes=pdes,
+        prule=prule, cache_dir=cache_dir, compact=compact, fuzzy=fuzzy,
+        matcher=matcher)
+
+    tmpdir = tempfile.mkdtemp(prefix='post_processing.')
+    try:
+        with instrument.stage('incremental.scan') as st:
+            tab_doc = read_tab_by_doc(ptab)
+            ranks, hashes, dirty, pdirty = scan(pbio, tab_doc, manifest,
+                                                tmpdir)
+            st.count(docs=len(hashes))
+        logger.info('%s of %s docs changed' % (len(dirty), len(hashes)))
+        lines = sorted(i for docid in dirty for i in tab_doc.get(docid, ()))
+        res, rm_histories, rule_count, rule_histories = parallel.run_docs(
+            lines, pdirty, resources, filters, rule_index,
+            {'sn': sn, 'mtype': mtype, 'columns': columns})
+    finally:
+        shutil.rmtree(tmpdir)
+
+    with instrument.stage('merge') as st:
+        # keys relative to the document, so they survive edits elsewhere
+        pos = {n: k for docid in dirty
+               for k, (n, line) in enumerate(tab_doc.get(docid, ()))}
+        new = defaultdict(list)
+        for key, i in res:
+            if key[0] == 0:
+                key = (0, pos[key[1]])
+            else:
+                key = (key[0], key[2])
+            new[i.docid].append((key, str(i)))
+        docs = {}
+        for docid in hashes:
+            if docid in dirty:
+                docs[docid] = (hashes[docid], new.get(docid, []))
+            else:
+                docs[docid] = manifest.docs[docid]
+        manifest.docs = docs
+
+        merged = []
+        for docid, (h, items) in docs.items():
+            for key, line in items:
+                if key[0] == 0:
+                    key = (0, tab_doc[docid][key[1]][0])
+                else:
+                    key = (key[0], ranks[docid], key[1])
+                merged.append((key, line))
+        merged.sort()
+        tab = [util.TacTab(*line.split('\t')) for key, line in merged]
+        st.count(docs=len(docs), mentions=len(tab))
+
+    logger.info('\n------ REMOVING NAMES (changed docs) ------')
+    remove_names.log_histories(rm_histories)
+    if prule:
+        logger.info('------ APPLYING RULES (changed docs) ------')
+        rule.log_histories(rule_count, rule_histories)
+    return tab, manifest
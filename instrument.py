@@ -0,0 +1,168 @@
+import json
+import time
+import contextlib
+import logging
+import resource
+
+
+logger = logging.getLogger()
+
+# Stage records of this run, None while instrumentation is disabled
+_records = None
+_hooks = []
+
+
+def peak_rss():
+    # Peak resident set size of this process, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Stage(object):
+    __slots__ = ('name', 'docs', 'mentions', '_wall', '_cpu', '_rss')
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = None
+        self.mentions = None
+
+    def __enter__(self):
+        self._rss = peak_rss()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        record = {
+            'stage': self.name,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'peak_rss_delta_kb': peak_rss() - self._rss,
+            'docs': self.docs,
+            'mentions': self.mentions,
+            'docs_per_s': None,
+            'mentions_per_s': None,
+        }
+        if self.docs is not None and wall > 0:
+            record['docs_per_s'] = self.docs / wall
+        if self.mentions is not None and wall > 0:
+            record['mentions_per_s'] = self.mentions / wall
+        if _records is not None:
+            _records.append(record)
+        for hook in _hooks:
+            hook(record)
+
+    def count(self, docs=None, mentions=None):
+        if docs is not None:
+            self.docs = docs
+        if mentions is not None:
+            self.mentions = mentions
+
+    def count_tab(self, tab):
+        self.mentions = len(tab)
+        self.docs = len(set(i.docid for i in tab))
+
+    def count_docs(self, bio):
+        # Pass a (docid, tokens) stream through, counting its documents
+        self.docs = 0
+        for doc in bio:
+            self.docs += 1
+            yield doc
+
+
+class NullStage(object):
+    # Shared stand-in returned while disabled; every method is a no-op
+    __slots__ = ()
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def count(self, docs=None, mentions=None):
+        pass
+
+    def count_tab(self, tab):
+        pass
+
+    def count_docs(self, bio):
+        return bio
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name):
+    if _records is None and not _hooks:
+        return NULL_STAGE
+    return Stage(name)
+
+
+def enable(hook=None):
+    global _records
+    if _records is None:
+        _records = []
+    if hook is not None:
+        _hooks.append(hook)
+
+
+def disable():
+    global _records
+    _records = None
+    del _hooks[:]
+
+
+def enabled():
+    return _records is not None or bool(_hooks)
+
+
+@contextlib.contextmanager
+def paused():
+    # Nothing inside is recorded, e.g. the per-document stages of a stream
+    global _records, _hooks
+    saved = _records, _hooks
+    _records, _hooks = None, []
+    try:
+        yield
+    finally:
+        _records, _hooks = saved
+
+
+def records():
+    return list(_records or [])
+
+
+def reset():
+    if _records is not None:
+        del _records[:]
+
+
+def extend(records, **tags):
+    # Add records measured elsewhere, e.g. in worker processes
+    if _records is None:
+        return
+    for record in records:
+        record = dict(record)
+        record.update(tags)
+        _records.append(record)
+
+
+def report():
+    stages = records()
+    return {
+        'stages': stages,
+        'wall_seconds': sum(i['wall_seconds'] for i in stages
+                            if 'shard' not in i),
+        'cpu_seconds': sum(i['cpu_seconds'] for i in stages),
+        'peak_rss_kb': peak_rss(),
+    }
+
+
+def write_report(path):
+    with open(path, 'w') as fw:
+        json.dump(report(), fw, indent=2)
+    logger.info('run report written to %s' % path)
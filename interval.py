@@ -0,0 +1,177 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+
+def overlap_groups(mentions):
+    # Sweep mentions of one document sorted by offset and yield groups of
+    # transitively overlapping mentions. Offsets are inclusive, so mentions
+    # sharing a boundary character overlap.
+    group = []
+    group_end = None
+    for i in sorted(mentions, key=lambda x: (x.beg, x.end)):
+        if group and i.beg > group_end:
+            yield group
+            group = []
+        if not group or i.end > group_end:
+            group_end = i.end
+        group.append(i)
+    if group:
+        yield group
+
+
+def select_non_overlapping(group, key):
+    # Greedily keep mentions in `key` order, skipping any mention that
+    # overlaps one already kept. Kept spans are disjoint, so a new span only
+    # needs to be checked against its two neighbours.
+    begs = []
+    ends = []
+    res = []
+    for i in sorted(group, key=key):
+        n = bisect_left(begs, i.beg)
+        if n > 0 and ends[n-1] >= i.beg:
+            continue
+        if n < len(begs) and begs[n] <= i.end:
+            continue
+        begs.insert(n, i.beg)
+        ends.insert(n, i.end)
+        res.append(i)
+    return res
+
+
+class SortedBlocks(object):
+    # Sorted list kept as a list of sorted blocks of at most 2 * load items
+    # and the first item of each block. An update bisects the block heads
+    # and shifts items of one block only, instead of every item after it,
+    # so updates stay cheap however many mentions a document has.
+    def __init__(self, load=256):
+        self.load = load
+        self._blocks = []
+        self._heads = []
+
+    def add(self, item):
+        blocks = self._blocks
+        heads = self._heads
+        if not blocks:
+            blocks.append([item])
+            heads.append(item)
+            return
+        k = max(bisect_right(heads, item) - 1, 0)
+        block = blocks[k]
+        insort(block, item)
+        heads[k] = block[0]
+        if len(block) > 2 * self.load:
+            blocks.insert(k + 1, block[self.load:])
+            heads.insert(k + 1, block[self.load])
+            del block[self.load:]
+
+    def remove(self, item):
+        blocks = self._blocks
+        heads = self._heads
+        k = bisect_right(heads, item) - 1
+        block = blocks[k]
+        del block[bisect_left(block, item)]
+        if block:
+            heads[k] = block[0]
+        else:
+            del blocks[k]
+            del heads[k]
+
+    def irange(self, lo, hi):
+        # Items in [lo, hi], in order
+        blocks = self._blocks
+        k = max(bisect_left(self._heads, lo) - 1, 0)
+        if k >= len(blocks):
+            return
+        n = bisect_left(blocks[k], lo)
+        while k < len(blocks):
+            block = blocks[k]
+            for j in range(n, len(block)):
+                if block[j] > hi:
+                    return
+                yield block[j]
+            k += 1
+            n = 0
+
+
+class MentionIndex(object):
+    # Mutable index over a tab. Mentions are kept in tab order and, per
+    # document, as spans sorted by offset in SortedBlocks, so overlap and
+    # duplicate lookups bisect into one document instead of scanning it.
+    # Additions and removals update the index in place, moving at most one
+    # block of spans, which lets every merge of the add-names stage share
+    # one index.
+    #
+    # Each extend() call opens a new segment, and every mention gets an
+    # order key (segment, docid, position among the batch's mentions of that
+    # document) unless explicit keys are given. A run over any subset of
+    # documents produces the same keys, so sharded results can be merged
+    # back into serial order.
+    def __init__(self, tab=(), keys=None):
+        self._log = []
+        self._keys = []
+        self._segment = 0
+        self._seq = {}
+        self._removed = set()
+        self._spans = defaultdict(SortedBlocks)
+        self._maxlen = defaultdict(int)
+        self.extend(tab, keys=keys)
+
+    def __len__(self):
+        return len(self._log) - len(self._removed)
+
+    def __iter__(self):
+        removed = self._removed
+        for seq, i in enumerate(self._log):
+            if seq not in removed:
+                yield i
+
+    def items(self):
+        removed = self._removed
+        for seq, i in enumerate(self._log):
+            if seq not in removed:
+                yield self._keys[seq], i
+
+    def add(self, mention, key):
+        seq = len(self._log)
+        self._log.append(mention)
+        self._keys.append(key)
+        self._seq[id(mention)] = seq
+        self._spans[mention.docid].add((mention.beg, mention.end, seq))
+        if mention.end - mention.beg > self._maxlen[mention.docid]:
+            self._maxlen[mention.docid] = mention.end - mention.beg
+
+    def extend(self, tab, keys=None):
+        segment = self._segment
+        self._segment += 1
+        if keys is not None:
+            for i, key in zip(tab, keys):
+                self.add(i, (segment,) + tuple(key))
+            return
+        pos = defaultdict(int)
+        for i in tab:
+            self.add(i, (segment, i.docid, pos[i.docid]))
+            pos[i.docid] += 1
+
+    def query(self, docid, beg, end):
+        # Mentions of docid sharing at least one position with [beg, end],
+        # in tab order.
+        spans = self._spans.get(docid)
+        if spans is None:
+            return []
+        res = [seq for b, e, seq in spans.irange((beg - self._maxlen[docid],),
+                                                 (end, float('inf')))
+               if e >= beg]
+        return [self._log[seq] for seq in sorted(res)]
+
+    def discard(self, mention):
+        seq = self._seq.pop(id(mention), None)
+        if seq is None:
+            return
+        self._spans[mention.docid].remove((mention.beg, mention.end, seq))
+        self._removed.add(seq)
+
+    def remove_offset(self, mention):
+        # Drop every mention sharing mention's offset string
+        for i in self.query(mention.docid, mention.beg, mention.end):
+            if i.offset == mention.offset:
+                self.discard(i)
@@ -0,0 +1,207 @@
+import os
+import zlib
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from collections import defaultdict
+
+import util
+import cache
+import interval
+import decisions
+import instrument
+import remove_names
+import add_names
+import rule
+
+
+logger = logging.getLogger()
+
+# Filled by the parent before the pool forks. Workers read resources, the
+# compiled filters and rules, and their share of the tab through
+# copy-on-write pages instead of reloading or unpickling them.
+_shared = {}
+
+
+def split_bio(pbio, n_shards, outdir):
+    # Deal documents round-robin in BIO order into one file per shard.
+    # Returns docid -> rank of the document in the BIO file.
+    ranks = {}
+    paths = [os.path.join(outdir, 'shard%s.bio' % k) for k in range(n_shards)]
+    fws = [open(p, 'w') for p in paths]
+    try:
+        for docid, doc in util.iter_bio(pbio, compact=True):
+            if docid not in ranks:
+                ranks[docid] = len(ranks)
+            fw = fws[ranks[docid] % n_shards]
+            for tok, beg, end in doc:
+                fw.write('%s %s:%s-%s\n' % (tok, docid, beg, end))
+            fw.write('\n')
+    finally:
+        for fw in fws:
+            fw.close()
+    return ranks, paths
+
+
+def split_tab(ptab, ranks, n_shards):
+    # Names follow their document's shard; names of documents missing from
+    # the BIO only go through the filters and rules, so any shard will do.
+    res = [[] for _ in range(n_shards)]
+    with open(ptab, 'r') as f:
+        for n, line in enumerate(f):
+            docid = util.parse_offset(line.split('\t')[3])[0]
+            if docid in ranks:
+                shard = ranks[docid] % n_shards
+            else:
+                shard = zlib.crc32(docid.encode('utf-8')) % n_shards
+            res[shard].append((n, line))
+    return res
+
+
+def run_docs(lines, pbio, resources, filters, rule_index, opts, cands=None):
+    # Runs remove_names, add_names and rules over numbered tab lines
+    # [(lineno, line)] and the documents of pbio, or the candidates found
+    # in them beforehand. Names are returned as (key, mention) pairs:
+    # (0, lineno) for names of the tab and (segment, docid, position) for
+    # added names, see serial_key().
+    with instrument.stage('load.tab') as st:
+        tab = [util.TacTab(*line.rstrip('\n').split('\t'))
+               for n, line in lines]
+        lineno = {id(i): n for i, (n, line) in zip(tab, lines)}
+        st.count_tab(tab)
+
+    with instrument.stage('remove') as st:
+        st.count_tab(tab)
+        if opts['columns']:
+            tab, rm_histories = remove_names.filter_columns(
+                tab, filters, psm=resources['psm'])
+        else:
+            tab, rm_histories = remove_names.filter_tab(
+                tab, [f for name, f in filters])
+
+    index = interval.MentionIndex(tab, keys=[(lineno[id(i)],) for i in tab])
+    add_names.process(index, pbio, sn=opts['sn'], mtype=opts['mtype'],
+                      resources=resources, columns=opts['columns'],
+                      cands=cands)
+    res = list(index.items())
+
+    rule_count = {}
+    rule_histories = {}
+    if rule_index is not None:
+        with instrument.stage('rules') as st:
+            st.count(mentions=len(res))
+            kept, rule_count, rule_histories = rule.apply_rules(
+                [i for key, i in res], *rule_index)
+            kept = set(id(i) for i in kept)
+            res = [(key, i) for key, i in res if id(i) in kept]
+    return res, dict(rm_histories), dict(rule_count), dict(rule_histories)
+
+
+def run_shard(k):
+    logging.root.setLevel(level=logging.WARNING)
+    # drop the parent's records inherited through fork
+    instrument.reset()
+    decisions.start_shard(k)
+    res = run_docs(_shared['tabs'][k], _shared['pbios'][k],
+                   _shared['resources'], _shared['filters'], _shared['rule'],
+                   _shared['opts'])
+    return res + (instrument.records(), decisions.end_shard())
+
+
+def serial_key(key, ranks):
+    # Sort key of a name in a serial run: names of the tab in line order,
+    # then each batch of added names in BIO document order
+    if key[0] == 0:
+        return key
+    return (key[0], ranks[key[1]], key[2])
+
+
+def merge(results, ranks):
+    # Concatenate shard results, restore serial order and sum histories
+    res = []
+    rm_histories = defaultdict(int)
+    rule_count = defaultdict(int)
+    rule_histories = defaultdict(int)
+    for k, (items, rmh, rc, rh, records, n) in enumerate(results):
+        instrument.extend(records, shard=k)
+        res += items
+        for i, c in rmh.items():
+            rm_histories[i] += c
+        for i, c in rc.items():
+            rule_count[i] += c
+        for i, c in rh.items():
+            rule_histories[i] += c
+
+    decisions.join_shards(len(results), [i[-1] for i in results])
+    res.sort(key=lambda x: serial_key(x[0], ranks))
+    return [i for key, i in res], rm_histories, rule_count, rule_histories
+
+
+def load(lower=False, lang=None, ppsm=None, pgaz=None, psn=None, pdes=None,
+         prule=None, cache_dir=None, compact=False, fuzzy=0, matcher=None):
+    # Resources, filters and compiled rules for run_docs()
+    logger.info('------ LOADING RESOURCES ------')
+    resources = add_names.load_resources(
+        lower=lower, ppsm=ppsm, pgaz=pgaz, psn=psn, pdes=pdes,
+        cache_dir=cache_dir, compact=compact, fuzzy=fuzzy,
+        matcher=add_names.gaz_matcher(lang, matcher))
+    filters = remove_names.build_filters(psm=resources['psm'], lang=lang)
+    rule_index = None
+    if prule:
+        with instrument.stage('load.rules'):
+            rule_index = cache.read_rule(prule, lower=lower,
+                                         cache_dir=cache_dir) + \
+                (resources['vocab'],)
+    return resources, filters, rule_index
+
+
+def process(pbio, ptab, workers, lower=False, lang=None, ppsm=None,
+            pgaz=None, psn=None, pdes=None, prule=None, sn=True,
+            mtype='NAM', cache_dir=None, columns=False, compact=False,
+            fuzzy=0, matcher=None):
+    # Runs remove_names, add_names and rules on document shards in a process
+    # pool and merges the shards back into the order of a serial run.
+    # Assumes each document's lines are contiguous in the BIO file.
+    resources, filters, rule_index = load(
+        lower=lower, lang=lang, ppsm=ppsm, pgaz=pgaz, psn=psn, pdes=pdes,
+        prule=prule, cache_dir=cache_dir, compact=compact, fuzzy=fuzzy,
+        matcher=matcher)
+
+    tmpdir = tempfile.mkdtemp(prefix='post_processing.')
+    try:
+        logger.info('------ SHARDING %s ------' % workers)
+        with instrument.stage('shard') as st:
+            ranks, pbios = split_bio(pbio, workers, tmpdir)
+            tabs = split_tab(ptab, ranks, workers)
+            st.count(docs=len(ranks), mentions=sum(len(i) for i in tabs))
+        logger.info('%s docs, %s names' % (len(ranks),
+                                           sum(len(i) for i in tabs)))
+        _shared.update({
+            'opts': {'sn': sn, 'mtype': mtype, 'columns': columns},
+            'resources': resources,
+            'filters': filters,
+            'rule': rule_index,
+            'tabs': tabs,
+            'pbios': pbios,
+        })
+        decisions.flush()
+        ctx = multiprocessing.get_context('fork')
+        with instrument.stage('workers') as st:
+            st.count(docs=len(ranks), mentions=sum(len(i) for i in tabs))
+            with ctx.Pool(workers) as pool:
+                results = pool.map(run_shard, range(workers))
+    finally:
+        _shared.clear()
+        shutil.rmtree(tmpdir)
+
+    with instrument.stage('merge') as st:
+        res, rm_histories, rule_count, rule_histories = merge(results, ranks)
+        st.count(mentions=len(res))
+
+    logger.info('\n------ REMOVING NAMES ------')
+    remove_names.log_histories(rm_histories)
+    if prule:
+        logger.info('------ APPLYING RULES ------')
+        rule.log_histories(rule_count, rule_histories)
+    return res
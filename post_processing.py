@@ -6,20 +6,30 @@ import util
 import remove_names
 import add_names
 import rule
+import parallel
+import columnar
+import decisions
+import incremental
+import instrument
+import stream
 
 
 
-def reassign_id(tab, runid='RPI_BLENDER'):
+def reassign_id(tab, runid='RPI_BLENDER', numbers=None):
+    # numbers, when given, holds the number of each name's qid; names are
+    # numbered in tab order otherwise
     count = defaultdict(int)
-    n = 0
+    if numbers is None:
+        numbers = range(len(tab))
     logger.info('--- REASSIGNING ID ---')
-    for i in tab:
-        qid = 'M_' + '{number:0{width}d}'.format(width=7,
-                                                 number=n)
-        i.runid = runid
-        i.qid = qid
-        count[i.etype] += 1
-        n += 1
+    with instrument.stage('reassign_id') as st:
+        st.count(mentions=len(tab))
+        for i, n in zip(tab, numbers):
+            qid = 'M_' + '{number:0{width}d}'.format(width=7,
+                                                     number=n)
+            i.runid = runid
+            i.qid = qid
+            count[i.etype] += 1
 
     logger.info('total names: %s' % len(tab))
     for i in count:
@@ -42,20 +52,123 @@ if __name__ == '__main__':
     parser.add_argument('--prule', type=str, help='path to rules file')
     parser.add_argument('--lower', action='store_true', default=False,
                         help='lowercase mode')
+    parser.add_argument('--lang', type=str, choices=sorted(
+        i for i in remove_names.VALID_CHAR_RANGES if i),
+        help='language of valid chars')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory of compiled gaz and rule caches')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='# of processes, each handling a shard of '
+                        'documents')
+    parser.add_argument('--report', type=str,
+                        help='path of a JSON report of per-stage timing, '
+                        'throughput and memory')
+    parser.add_argument('--columnar', action='store_true', default=False,
+                        help='resolve conflicts and filter names over '
+                        'columnar NumPy arrays')
+    parser.add_argument('--incremental', type=str,
+                        help='path to a manifest of the previous run; only '
+                        'changed documents are reprocessed and names keep '
+                        'their ids')
+    parser.add_argument('--decisions', type=str,
+                        help='path of a log of every removal, addition and '
+                        'etype revision')
+    parser.add_argument('--decisions-format', type=str,
+                        choices=decisions.FORMATS, default='jsonl',
+                        help='format of the decision log')
+    parser.add_argument('--decisions-sample', type=float, default=1.0,
+                        help='fraction of names whose decisions are logged')
+    parser.add_argument('--compact-gaz', action='store_true', default=False,
+                        help='keep gazetteers in compact arrays rather than '
+                        'dicts, for a fraction of the memory')
+    parser.add_argument('--fuzzy', type=int, default=0,
+                        help='also match gazetteer entries within this '
+                        'edit distance in SN and DF documents; such names '
+                        'are untrusted (p2). With the char gazetteer matcher '
+                        'only SN names are matched approximately')
+    parser.add_argument('--gaz-matcher', type=str, choices=add_names.MATCHERS,
+                        help='match gazetteers on BIO tokens or on the '
+                        'characters of the text; characters by default for '
+                        '--lang %s' % ', '.join(add_names.CHAR_LANGS))
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='push one document at a time through every '
+                        'stage and write its names right away; names are '
+                        'grouped by document')
     args = parser.parse_args()
+    if args.incremental and args.workers > 1:
+        parser.error('--incremental runs with a single worker')
+    if args.stream and (args.incremental or args.workers > 1):
+        parser.error('--stream runs alone, without --incremental or '
+                     '--workers')
+    if args.columnar and not columnar.available():
+        parser.error('--columnar needs numpy')
+    if args.report:
+        instrument.enable()
+    if args.decisions:
+        decisions.enable(args.decisions, fmt=args.decisions_format,
+                         sample=args.decisions_sample)
 
     logger.info('loading tab...')
     logger.info('%s' % args.ptab)
-    tab = util.read_tab(args.ptab)
-    tab = remove_names.process(tab, ppsm=args.ppsm)
-    tab = add_names.process(tab, args.pbio, lower=args.lower,
-                            ppsm=args.ppsm, pgaz=args.pgaz,
-                            psn=args.psn, pdes=args.pdes)
-    if args.prule:
-        tab = rule.process(tab, args.prule, lower=args.lower)
-
-    reassign_id(tab)
-    with open(args.outpath, 'w') as fw:
-        fw.write('\n'.join([str(i) for i in tab]))
+    manifest = None
+    tab = None
+    if args.stream:
+        stream.process(args.pbio, args.ptab, args.outpath, lower=args.lower,
+                       lang=args.lang, ppsm=args.ppsm, pgaz=args.pgaz,
+                       psn=args.psn, pdes=args.pdes, prule=args.prule,
+                       cache_dir=args.cache_dir, columns=args.columnar,
+                       compact=args.compact_gaz, fuzzy=args.fuzzy,
+                       matcher=args.gaz_matcher)
+    elif args.incremental:
+        tab, manifest = incremental.process(
+            args.pbio, args.ptab, args.incremental, lower=args.lower,
+            lang=args.lang, ppsm=args.ppsm, pgaz=args.pgaz, psn=args.psn,
+            pdes=args.pdes, prule=args.prule, cache_dir=args.cache_dir,
+            columns=args.columnar, compact=args.compact_gaz,
+            fuzzy=args.fuzzy, matcher=args.gaz_matcher)
+    elif args.workers > 1:
+        tab = parallel.process(args.pbio, args.ptab, args.workers,
+                               lower=args.lower, lang=args.lang,
+                               ppsm=args.ppsm, pgaz=args.pgaz, psn=args.psn,
+                               pdes=args.pdes, prule=args.prule,
+                               cache_dir=args.cache_dir,
+                               columns=args.columnar,
+                               compact=args.compact_gaz, fuzzy=args.fuzzy,
+                               matcher=args.gaz_matcher)
+    else:
+        if instrument.enabled():
+            # Load up front so reading is reported apart from removing
+            with instrument.stage('load.tab') as st:
+                tab = util.read_tab(args.ptab)
+                st.count_tab(tab)
+        else:
+            tab = util.iter_tab(args.ptab)
+        tab = remove_names.process(tab, ppsm=args.ppsm, lang=args.lang,
+                                   columns=args.columnar)
+        tab = add_names.process(tab, args.pbio, lower=args.lower,
+                                ppsm=args.ppsm, pgaz=args.pgaz,
+                                psn=args.psn, pdes=args.pdes,
+                                cache_dir=args.cache_dir,
+                                columns=args.columnar,
+                                compact=args.compact_gaz, fuzzy=args.fuzzy,
+                                matcher=add_names.gaz_matcher(
+                                    args.lang, args.gaz_matcher))
+        if args.prule:
+            tab = rule.process(tab, args.prule, lower=args.lower,
+                               cache_dir=args.cache_dir)
 
+    if manifest is not None:
+        reassign_id(tab, numbers=manifest.assign_ids(tab))
+    elif tab is not None:
+        reassign_id(tab)
+    if tab is not None:
+        with instrument.stage('write') as st:
+            st.count_tab(tab)
+            util.write_tab(tab, args.outpath)
+
+    decisions.disable()
+    if manifest is not None:
+        manifest.save()
+    if args.report:
+        instrument.write_report(args.report)
     logger.info('done.\n')
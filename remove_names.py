@@ -6,100 +6,174 @@ import argparse
 from collections import defaultdict
 
 import util
+import columnar
+import decisions
+import instrument
 
 
 logger = logging.getLogger()
 logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
 logging.root.setLevel(level=logging.INFO)
 LONG_NAME_THRES = 15
+# Scripts a name may be written in besides ASCII, per language. A name
+# whose characters all fall outside them is removed.
+VALID_CHAR_RANGES = {
+    None: [(0x0b00, 0x0b7f)], # Oriya
+    'or': [(0x0b00, 0x0b7f)], # Oriya
+    'ti': [(0x1200, 0x139f), (0x2d80, 0x2ddf)], # Ethiopic
+    'am': [(0x1200, 0x139f), (0x2d80, 0x2ddf)], # Ethiopic
+    'om': [(0x00c0, 0x024f)], # Latin extended
+    'so': [(0x00c0, 0x024f)], # Latin extended
+    'uig': [(0x0600, 0x06ff), (0xfb50, 0xfdff), (0xfe70, 0xfeff)], # Arabic
+    'zh': [(0x3400, 0x4dbf), (0x4e00, 0x9fff), (0xf900, 0xfaff)], # Han
+    'th': [(0x0e00, 0x0e7f)], # Thai
+    'my': [(0x1000, 0x109f), (0xaa60, 0xaa7f)], # Myanmar
+}
+RE_PUNCT = re.compile('[%s]*' % re.escape(string.punctuation))
+RE_HTTP = re.compile('http')
+RE_DIGITS = re.compile(r'\d+')
+# same matches as '\d+\:\d+' and '.+\.jpg' without the backtracking
+RE_RULE = re.compile(r'\d\:\d|.\.jpg')
+
+
+def compile_char_range(lang=None):
+    ranges = [(0, 127)] + VALID_CHAR_RANGES[lang]
+    return re.compile('[%s]' % ''.join('\\U%08x-\\U%08x' % (b, e)
+                                       for b, e in ranges))
+
+
+# Each filter factory takes the run configuration and returns a function
+# that maps a name to a reason code if the name should be removed, or None
+# otherwise.
+def filter_digits(psm=None, **kwargs):
+    def f(i):
+        if not i.mention.isdigit():
+            return None
+        if psm and i.docid in psm and i.mention in psm[i.docid]:
+            return None
+        if 'SN_' in i.docid:
+            return None
+        return 'IS_DIGITS'
+    return f
+
+
+def filter_punct(**kwargs):
+    def f(i):
+        if RE_PUNCT.fullmatch(i.mention):
+            return 'IS_PUNCT'
+    return f
+
+
+def filter_http(**kwargs):
+    def f(i):
+        if RE_HTTP.search(i.mention):
+            return 'HAS_HTTP'
+    return f
+
+
+def filter_has_digits(psm=None, **kwargs):
+    def f(i):
+        if not RE_DIGITS.search(i.mention):
+            return None
+        if psm and i.docid in psm and i.mention in psm[i.docid]:
+            return None
+        if 'SN_' in i.docid:
+            return None
+        return 'HAS_DIGITS'
+    return f
+
+
+def filter_long_name(**kwargs):
+    def f(i):
+        if len(i.mention.split()) >= LONG_NAME_THRES:
+            return 'IS_LONG'
+    return f
+
+
+def filter_char_range(lang=None, **kwargs):
+    valid_char = compile_char_range(lang)
+    def f(i):
+        if not valid_char.search(i.mention):
+            return 'INVALID_CHAR'
+    return f
+
+
+def filter_rule(**kwargs):
+    def f(i):
+        if RE_RULE.search(i.mention):
+            return 'RULE'
+    return f
+
 
+FILTERS = {
+    'digits': filter_digits,
+    'punct': filter_punct,
+    'http': filter_http,
+    'has_digits': filter_has_digits,
+    'long_name': filter_long_name,
+    'char_range': filter_char_range,
+    'rule': filter_rule,
+}
+FILTER_CHAIN = ['digits', 'punct', 'http', 'long_name', 'char_range', 'rule']
+# How reason codes read in the logged histories
+HISTORY_LABELS = {
+    'IS_LONG': 'IS_LONG(%s)' % LONG_NAME_THRES,
+    'INVALID_CHAR': 'INVALID CHAR',
+}
 
-def process(tab, outpath=None, ppsm=None, verbose=True):
+
+def build_filters(chain=FILTER_CHAIN, psm=None, lang=None):
+    return [(name, FILTERS[name](psm=psm, lang=lang)) for name in chain]
+
+
+def filter_tab(tab, filters):
+    # Histories count removals per (reason, mention, etype)
     new_tab = []
     histories = defaultdict(int)
+    log = decisions.active()
+    for i in tab:
+        for f in filters:
+            reason = f(i)
+            if reason:
+                histories[(reason, i.mention, i.etype)] += 1
+                if log:
+                    log.record('remove', reason, i, old=i.etype)
+                break
+        else:
+            new_tab.append(i)
+    return new_tab, histories
+
+
+def log_histories(histories):
+    logger.info('%s names are removed' % len(histories))
+    for (reason, mention, etype), c in sorted(
+            histories.items(), key=lambda x: x[1], reverse=True):
+        logger.info('  %s %s | %s | %s' % (HISTORY_LABELS.get(reason, reason),
+                                           mention, etype, c))
+
+
+def filter_columns(tab, filters, psm=None):
+    # filter_tab over the columnar form of the tab; needs numpy
+    return columnar.filter_tab(tab, filters, psm=psm,
+                               long_name_thres=LONG_NAME_THRES)
+
+
+def process(tab, outpath=None, ppsm=None, verbose=True, lang=None,
+            chain=FILTER_CHAIN, columns=False):
     psm = None
     if ppsm:
         psm = util.read_psm(ppsm)
+    filters = build_filters(chain, psm=psm, lang=lang)
 
     logger.info('\n------ REMOVING NAMES ------')
-    for i in tab:
-        remove = False
-
-        # 1. Is digits
-        if i.mention.isdigit():
-            if psm and i.docid in psm and i.mention in psm[i.docid]:
-                pass
-            elif 'SN_' in i.docid:
-                pass
-            else:
-                his = 'IS_DIGITS %s | %s' % (i.mention, i.etype)
-                histories[his] += 1
-                remove = True
-                continue
-
-        # 2. Is punctuation
-        translation = str.maketrans('', '', string.punctuation);
-        s = i.mention.translate(translation)
-        if s == '':
-            his = 'IS_PUNCT %s | %s' % (i.mention, i.etype)
-            histories[his] += 1
-            remove = True
-            continue
-
-        # 3. Contains HTTP
-        if re.search('http', i.mention):
-            his = 'HAS_HTTP %s | %s' % (i.mention, i.etype)
-            histories[his] += 1
-            remove = True
-            continue
-
-        # # 4. Contains digits
-        # if re.search('\d+', i.mention):
-        #     if psm and i.docid in psm and i.mention in psm[i.docid]:
-        #         pass
-        #     elif 'SN_' in i.docid:
-        #         pass
-        #     else:
-        #         his = 'HAS_DIGITS %s | %s' % (i.mention, i.etype)
-        #         histories[his] += 1
-        #         remove = True
-        #         continue
-
-        # 5. Long names
-        if len(i.mention.split()) >= LONG_NAME_THRES:
-            his = 'IS_LONG(%s) %s | %s' % (LONG_NAME_THRES, i.mention, i.etype)
-            histories[his] += 1
-            remove = True
-            continue
-
-        # 6. Valid char range
-        valid_range = list(range(0, 127+1))
-        valid_range += list(range(int('0b00', 16), int('0b7f', 16)+1)) # Ordia
-
-        r = [False for c in i.mention if ord(c) not in valid_range]
-        if len(r) == len(i.mention):
-            his = 'INVALID CHAR %s | %s' % (i.mention, i.etype)
-            histories[his] += 1
-            remove = True
-            continue
-
-        # 0. Rules
-        if re.search('\d+\:\d+|\d+\:\d+\:\d+', i.mention):
-            his = 'RULE %s | %s' % (i.mention, i.etype)
-            histories[his] += 1
-            remove = True
-        if re.search('.+\.jpg', i.mention):
-            his = 'RULE %s | %s' % (i.mention, i.etype)
-            histories[his] += 1
-            remove = True
-
-        if not remove:
-            new_tab.append(i)
-
+    with instrument.stage('remove') as st:
+        if columns:
+            new_tab, histories = filter_columns(tab, filters, psm=psm)
+        else:
+            new_tab, histories = filter_tab(tab, [f for name, f in filters])
+        st.count(mentions=len(new_tab) + sum(histories.values()))
     if verbose:
-        logger.info('%s names are removed' % len(histories))
-        for i, c in sorted(histories.items(), key=lambda x: x[1], reverse=True):
-            logger.info('  %s | %s' % (i, c))
+        log_histories(histories)
 
     if outpath:
         with open(outpath, 'w') as fw:
@@ -113,7 +187,9 @@ if __name__ == '__main__':
     parser.add_argument('ptab', type=str, help='path to tab')
     parser.add_argument('outpath', type=str, help='output path')
     parser.add_argument('--ppsm', type=str, help='path to psm')
+    parser.add_argument('--lang', type=str, choices=sorted(
+        i for i in VALID_CHAR_RANGES if i), help='language of valid chars')
     args = parser.parse_args()
 
-    tab = util.read_tab(args.ptab)
-    process(tab, outpath=args.outpath, ppsm=args.ppsm)
+    tab = util.iter_tab(args.ptab)
+    process(tab, outpath=args.outpath, ppsm=args.ppsm, lang=args.lang)
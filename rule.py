@@ -5,6 +5,9 @@ import argparse
 from collections import defaultdict
 
 import util
+import cache
+import decisions
+import instrument
 from util import TacTab
 
 logger = logging.getLogger()
@@ -12,55 +15,75 @@ logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
 logging.root.setLevel(level=logging.INFO)
 
 
-def process(tab, prule, outpath=None, lower=False, verbose=True):
+def apply_rules(tab, rule, exact, in_rm, vocab=None):
+    # Histories count rule hits per (op, mention, etype, op arguments). With
+    # a vocab (lowercase mode) mentions are matched by their folded keys.
     new_tab = []
     count = defaultdict(int)
     histories = defaultdict(int)
-    logger.info('------ APPLYING RULES ------')
-    rule = util.read_rule(prule, lower=lower)
+    log = decisions.active()
     for i in tab:
         rm = False
-        if i.mention in rule:
-            if 'ALL' in rule[i.mention]:
-                op = rule[i.mention]['ALL']
-            elif i.etype in rule[i.mention]:
-                op = rule[i.mention][i.etype]
+        mention = i.mention if vocab is None else vocab.key(i.mention)
+        if mention in rule:
+            if (mention, 'ALL') in exact:
+                op = exact[(mention, 'ALL')]
+            elif (mention, i.etype) in exact:
+                op = exact[(mention, i.etype)]
             else:
                 continue
+            his = (op[0], mention, i.etype, tuple(op[1]))
             if op[0] == 'mv':
                 if i.etype == op[1][0]:
                     continue
-                his = '%s: %s | %s -> %s' % (op[0], i.mention,
-                                            i.etype, ' | '.join(op[1]))
+                if log:
+                    log.record('rules', op[0], i, old=i.etype, new=op[1][0])
                 i.etype = op[1][0]
             elif op[0] == 'rm' or op[0] == 'in_rm':
                 rm = True
-                his = '%s: %s | %s | %s' % (op[0], i.mention,
-                                            i.etype, ' | '.join(op[1]))
+                if log:
+                    log.record('rules', op[0], i, old=i.etype)
             count[op[0]] += 1
             histories[his] += 1
         if not rm:
-            for r in rule:
-                if r in i.mention: # substring match
-                    if 'ALL' in rule[r]:
-                        op = rule[r]['ALL']
-                    elif i.etype in rule[r]:
-                        op = rule[r][i.etype]
-                    else:
-                        continue
-                    if op[0] == 'in_rm':
-                        rm = True
-                        his = '%s: %s | %s | %s' % (op[0], i.mention,
-                                                    i.etype, ' | '.join(op[1]))
+            for end, etypes in in_rm.search(mention): # substring match
+                if etypes is None or i.etype in etypes:
+                    rm = True
+                    if log:
+                        log.record('rules', 'in_rm.substring', i,
+                                   old=i.etype)
+                    break
         if not rm:
             new_tab.append(i)
+    return new_tab, count, histories
+
+
+def format_history(his):
+    op, mention, etype, args = his
+    if op == 'mv':
+        return '%s: %s | %s -> %s' % (op, mention, etype, ' | '.join(args))
+    return '%s: %s | %s | %s' % (op, mention, etype, ' | '.join(args))
+
 
+def log_histories(count, histories, verbose=True):
     for i in count:
         logger.info('# of %s: %s' % (i, count[i]))
     if verbose:
         for i, c in sorted(histories.items(), key=lambda x: x[1], reverse=True):
-            logger.info('%s | %s' % (i, c))
-    tab = new_tab
+            logger.info('%s | %s' % (format_history(i), c))
+
+
+def process(tab, prule, outpath=None, lower=False, verbose=True,
+            cache_dir=None):
+    logger.info('------ APPLYING RULES ------')
+    with instrument.stage('load.rules'):
+        rule, exact, in_rm = cache.read_rule(prule, lower=lower,
+                                             cache_dir=cache_dir)
+    with instrument.stage('rules') as st:
+        st.count_tab(tab)
+        tab, count, histories = apply_rules(tab, rule, exact, in_rm,
+                                            vocab=util.new_vocab(lower))
+    log_histories(count, histories, verbose=verbose)
     if outpath:
         with open(outpath, 'w') as fw:
             fw.write('\n'.join([str(i) for i in tab]))
@@ -75,5 +98,5 @@ if __name__ == '__main__':
     parser.add_argument('outpath', type=str, help='output path')
     args = parser.parse_args()
 
-    tab = util.read_tab(args.ptab)
+    tab = util.iter_tab(args.ptab)
     process(tab, args.prule, outpath=args.outpath)
@@ -0,0 +1,368 @@
+import os
+import json
+import math
+import time
+import queue
+import logging
+import argparse
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import util
+import parallel
+import add_names
+import remove_names
+
+
+logger = logging.getLogger()
+logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
+logging.root.setLevel(level=logging.INFO)
+
+
+class Job(object):
+    # One /process request: its tab lines and BIO documents, and the
+    # event its handler thread waits on
+    def __init__(self, tab, bio):
+        self.tab = tab
+        self.bio = bio
+        self.docids = set(bio)
+        for line in tab:
+            self.docids.add(util.parse_offset(line.split('\t')[3])[0])
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def parse_request(body):
+    # {"bio": BIO file text, "tab": tab file text} -> Job
+    req = json.loads(body)
+    tab = [i for i in req.get('tab', '').split('\n') if i.strip()]
+    for line in tab:
+        if len(line.split('\t')) != 8:
+            raise ValueError('tab line is not 8 columns: %r' % line)
+    bio_lines = req.get('bio', '').split('\n')
+    # util.parse_bio() exits on a bad line, so every line it will read is
+    # checked here first: a bad request is a 400, not a dropped connection
+    for line in bio_lines:
+        if not line.strip():
+            continue
+        ann = line.split(' ')
+        if len(ann) < 2:
+            raise ValueError('bio line is less than two columns: %r' % line)
+        try:
+            util.parse_offset(ann[1])
+        except ValueError:
+            raise ValueError('bad offset in bio line: %r' % line)
+    bio = {}
+    for docid, doc in util.parse_bio(bio_lines, compact=True):
+        if docid in bio:
+            bio[docid].extend(doc)
+        else:
+            bio[docid] = doc
+    return Job(tab, bio)
+
+
+def check_gaz_ops(gaz):
+    # GazetteerMatcher.emit() exits on an op other than p and p2, which
+    # would end the pipeline thread with the first document matching it
+    if gaz is None:
+        return
+    for mention, (etype, op, info) in gaz.items():
+        if op not in ('p', 'p2'):
+            raise ValueError('unrecognized gaz op %r of %r' % (op, mention))
+
+
+class Pipeline(object):
+    # Resources loaded once and the pipeline of post_processing.py run over
+    # a batch of jobs. Each job's names come back in the order and with the
+    # ids a serial run over that job's input alone would give them.
+    def __init__(self, lower=False, lang=None, ppsm=None, pgaz=None,
+                 psn=None, pdes=None, prule=None, sn=True, mtype='NAM',
+                 cache_dir=None, columns=False, compact=False, fuzzy=0,
+                 matcher=None, runid='RPI_BLENDER'):
+        self.resources, self.filters, self.rule_index = parallel.load(
+            lower=lower, lang=lang, ppsm=ppsm, pgaz=pgaz, psn=psn,
+            pdes=pdes, prule=prule, cache_dir=cache_dir, compact=compact,
+            fuzzy=fuzzy, matcher=matcher)
+        check_gaz_ops(self.resources['gaz'])
+        self.opts = {'sn': sn, 'mtype': mtype, 'columns': columns}
+        self.runid = runid
+
+    def run(self, jobs):
+        lines = []
+        bio = {}
+        owner = {}
+        for k, job in enumerate(jobs):
+            for docid in job.docids:
+                owner[docid] = k
+            lines.extend(enumerate(job.tab, len(lines)))
+            bio.update(job.bio)
+        ranks = {docid: n for n, docid in enumerate(bio)}
+        res = parallel.run_docs(lines, bio, self.resources, self.filters,
+                                self.rule_index, self.opts)[0]
+        res.sort(key=lambda x: parallel.serial_key(x[0], ranks))
+
+        results = [[] for _ in jobs]
+        for key, i in res:
+            tab = results[owner[i.docid]]
+            i.runid = self.runid
+            i.qid = 'M_' + '{number:0{width}d}'.format(width=7,
+                                                     number=len(tab))
+            tab.append(str(i))
+        return results
+
+
+class Batcher(object):
+    # Runs jobs on a single thread, since the stages share module state.
+    # Jobs queued while a batch runs, or within max_wait of its first job,
+    # join the next batch up to max_docs documents, unless their docids
+    # collide with a job already in it.
+    def __init__(self, pipeline, stats, max_docs=256, max_wait=0.005):
+        self.pipeline = pipeline
+        self.stats = stats
+        self.max_docs = max_docs
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self._carry = None
+        thread = threading.Thread(target=self._loop, daemon=True)
+        thread.start()
+
+    def submit(self, job):
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _next_batch(self):
+        job = self._carry or self.queue.get()
+        self._carry = None
+        batch = [job]
+        docids = set(job.docids)
+        deadline = time.monotonic() + self.max_wait
+        while len(docids) < self.max_docs:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    job = self.queue.get(timeout=timeout)
+                else:
+                    job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if docids & job.docids:
+                self._carry = job
+                break
+            batch.append(job)
+            docids |= job.docids
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.pipeline.run(batch)
+            except BaseException as e:
+                # a stage calling exit() must fail its batch, not end the
+                # only thread running batches
+                logger.exception('batch of %s requests failed' % len(batch))
+                if not isinstance(e, Exception):
+                    e = RuntimeError('batch aborted: %r' % e)
+                for job in batch:
+                    job.error = e
+                    job.done.set()
+                continue
+            self.stats.add_batch(len(batch))
+            for job, res in zip(batch, results):
+                job.result = res
+                job.done.set()
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return None
+    n = max(math.ceil(q / 100.0 * len(values)) - 1, 0)
+    return values[min(n, len(values) - 1)]
+
+
+class Stats(object):
+    # Counters and a window of the latest request latencies
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.docs = 0
+        self.mentions = 0
+        self.batches = 0
+        self.batched_requests = 0
+
+    def add_request(self, seconds, docs, mentions):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.docs += docs
+            self.mentions += mentions
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_requests += size
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            res = {
+                'uptime_seconds': time.time() - self.started,
+                'requests': self.requests,
+                'errors': self.errors,
+                'docs': self.docs,
+                'mentions': self.mentions,
+                'batches': self.batches,
+                'mean_batch_size': self.batched_requests / self.batches
+                if self.batches else None,
+            }
+        ms = [i * 1000 for i in latencies]
+        res['latency_ms'] = {
+            'window': len(ms),
+            'mean': sum(ms) / len(ms) if ms else None,
+            'p50': percentile(ms, 50),
+            'p90': percentile(ms, 90),
+            'p95': percentile(ms, 95),
+            'p99': percentile(ms, 99),
+            'max': ms[-1] if ms else None,
+        }
+        return res
+
+
+class Handler(BaseHTTPRequestHandler):
+    # POST /process with {"bio": ..., "tab": ...} returns {"tab": ...},
+    # GET /stats returns Stats.snapshot() and GET /health returns ok
+    protocol_version = 'HTTP/1.1'
+    batcher = None
+    stats = None
+
+    def log_message(self, format, *args):
+        # client_address is empty on a Unix socket
+        logger.debug(format % args)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.stats.snapshot())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found: %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/process':
+            self.send_json(404, {'error': 'not found: %s' % self.path})
+            return
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            job = parse_request(body)
+        except (ValueError, KeyError, AttributeError) as e:
+            self.stats.add_error()
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            tab = self.batcher.submit(job)
+        except Exception as e:
+            self.stats.add_error()
+            self.send_json(500, {'error': str(e)})
+            return
+        self.stats.add_request(time.perf_counter() - start,
+                               len(job.docids), len(tab))
+        self.send_json(200, {'tab': '\n'.join(tab)})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(pipeline, host='127.0.0.1', port=8080, unix=None,
+                max_docs=256, max_wait=0.005):
+    stats = Stats()
+    handler = type('Handler', (Handler,), {
+        'batcher': Batcher(pipeline, stats, max_docs=max_docs,
+                           max_wait=max_wait),
+        'stats': stats,
+    })
+    if unix:
+        if os.path.exists(unix):
+            os.remove(unix)
+        return ThreadingUnixHTTPServer(unix, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ppsm', type=str, help='path to psm')
+    parser.add_argument('--pgaz', type=str, help='path to gaz')
+    parser.add_argument('--psn', type=str, help='path to sn gaz')
+    parser.add_argument('--pdes', type=str, help='path to des')
+    parser.add_argument('--prule', type=str, help='path to rules file')
+    parser.add_argument('--lower', action='store_true', default=False,
+                        help='lowercase mode')
+    parser.add_argument('--lang', type=str, choices=sorted(
+        i for i in remove_names.VALID_CHAR_RANGES if i),
+        help='language of valid chars')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory of compiled gaz and rule caches')
+    parser.add_argument('--compact-gaz', action='store_true', default=False,
+                        help='keep gazetteers in compact arrays')
+    parser.add_argument('--fuzzy', type=int, default=0,
+                        help='also match gazetteer entries within this '
+                        'edit distance in SN and DF documents, as p2; only '
+                        'SN names with the char gazetteer matcher')
+    parser.add_argument('--gaz-matcher', type=str, choices=add_names.MATCHERS,
+                        help='match gazetteers on tokens or characters, by '
+                        'default characters for %s' % ', '.join(
+                            add_names.CHAR_LANGS))
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('--unix', type=str,
+                        help='listen on this Unix socket instead')
+    parser.add_argument('--max-batch-docs', type=int, default=256,
+                        help='max # of documents run in one batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5,
+                        help='how long a batch waits for more requests')
+    args = parser.parse_args()
+
+    pipeline = Pipeline(lower=args.lower, lang=args.lang, ppsm=args.ppsm,
+                        pgaz=args.pgaz, psn=args.psn, pdes=args.pdes,
+                        prule=args.prule, cache_dir=args.cache_dir,
+                        compact=args.compact_gaz, fuzzy=args.fuzzy,
+                        matcher=args.gaz_matcher)
+    server = make_server(pipeline, host=args.host, port=args.port,
+                         unix=args.unix, max_docs=args.max_batch_docs,
+                         max_wait=args.max_wait_ms / 1000.0)
+    logger.info('serving on %s' % (args.unix or '%s:%s' % (args.host,
+                                                          args.port)))
+    # the stages log every call, which would be every batch here
+    logging.root.setLevel(level=logging.WARNING)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
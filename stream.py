@@ -0,0 +1,122 @@
+import logging
+from array import array
+from collections import defaultdict
+
+import util
+import parallel
+import instrument
+import remove_names
+import rule
+
+
+logger = logging.getLogger()
+
+
+def index_tab(ptab):
+    # docid -> byte offsets of its lines in the tab, in tab order
+    res = {}
+    pos = 0
+    with open(ptab, 'rb') as f:
+        for line in f:
+            offset = line.split(b'\t')[3].decode('utf-8')
+            docid = util.parse_offset(offset)[0]
+            if docid not in res:
+                res[docid] = array('q')
+            res[docid].append(pos)
+            pos += len(line)
+    return res
+
+
+def decode_line(line):
+    # A tab line read in binary mode as text mode would read it, with a
+    # '\r\n' or '\r' line ending turned into '\n'
+    line = line.decode('utf-8')
+    if line.endswith('\r\n'):
+        return line[:-2] + '\n'
+    if line.endswith('\r'):
+        return line[:-1] + '\n'
+    return line
+
+
+def iter_docs(pbio, ptab):
+    # Yields (docid, bio, [(pos, line)]) for every document of the BIO file
+    # and then for the documents only found in the tab, bio being a
+    # one-document dict for add_names. A document's tab lines are read
+    # back by offset when it comes up.
+    index = index_tab(ptab)
+    with open(ptab, 'rb') as f:
+        def read_lines(docid):
+            res = []
+            for pos in index.pop(docid, ()):
+                f.seek(pos)
+                res.append((pos, decode_line(f.readline())))
+            return res
+        for docid, doc in util.iter_bio(pbio, compact=True):
+            yield docid, {docid: doc}, read_lines(docid)
+        for docid in list(index):
+            yield docid, {}, read_lines(docid)
+
+
+def process(pbio, ptab, outpath, lower=False, lang=None, ppsm=None,
+            pgaz=None, psn=None, pdes=None, prule=None, sn=True,
+            mtype='NAM', cache_dir=None, columns=False, compact=False,
+            fuzzy=0, matcher=None, runid='RPI_BLENDER'):
+    # Pushes one document at a time through remove_names, add_names, rules
+    # and id assignment, and appends its names to outpath right away, so
+    # memory is bound by the largest document plus an index of tab line
+    # offsets. Names come out grouped by document in BIO order, documents
+    # only found in the tab last; within a document they keep the order of
+    # a serial run.
+    resources, filters, rule_index = parallel.load(
+        lower=lower, lang=lang, ppsm=ppsm, pgaz=pgaz, psn=psn, pdes=pdes,
+        prule=prule, cache_dir=cache_dir, compact=compact, fuzzy=fuzzy,
+        matcher=matcher)
+    opts = {'sn': sn, 'mtype': mtype, 'columns': columns}
+
+    rm_histories = defaultdict(int)
+    rule_count = defaultdict(int)
+    rule_histories = defaultdict(int)
+    count = defaultdict(int)
+    n = 0
+    n_docs = 0
+    logger.info('------ STREAMING DOCUMENTS ------')
+    # the stages log per call, which would be per document here
+    level = logging.root.level
+    logging.root.setLevel(logging.WARNING)
+    try:
+        with instrument.stage('stream') as st, open(outpath, 'w') as fw:
+            for docid, bio, lines in iter_docs(pbio, ptab):
+                with instrument.paused():
+                    res, rmh, rc, rh = parallel.run_docs(
+                        lines, bio, resources, filters, rule_index, opts)
+                for i, c in rmh.items():
+                    rm_histories[i] += c
+                for i, c in rc.items():
+                    rule_count[i] += c
+                for i, c in rh.items():
+                    rule_histories[i] += c
+
+                res.sort(key=lambda x: x[0])
+                for key, i in res:
+                    i.runid = runid
+                    i.qid = 'M_' + '{number:0{width}d}'.format(width=7,
+                                                             number=n)
+                    if n:
+                        fw.write('\n')
+                    fw.write(str(i))
+                    count[i.etype] += 1
+                    n += 1
+                n_docs += 1
+            st.count(docs=n_docs, mentions=n)
+    finally:
+        logging.root.setLevel(level)
+
+    logger.info('\n------ REMOVING NAMES ------')
+    remove_names.log_histories(rm_histories)
+    if prule:
+        logger.info('------ APPLYING RULES ------')
+        rule.log_histories(rule_count, rule_histories)
+    logger.info('%s docs streamed' % n_docs)
+    logger.info('total names: %s' % n)
+    for i in count:
+        logger.info('%s %s' % (i, count[i]))
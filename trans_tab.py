@@ -1,57 +1,139 @@
 import os
 import sys
 import re
+import math
+import heapq
+import functools
+from array import array
 from collections import defaultdict
-import itertools
 import logging
 import argparse
 
+from gazetteer import StringPool
+
 
 logger = logging.getLogger()
 logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s')
 logging.root.setLevel(level=logging.INFO)
 
 
+class RankedDic(object):
+    # Read-only src -> ranked translations index over flat arrays: the
+    # translations of source n are entries trg_start[n]:trg_start[n+1] of
+    # trg/count, most frequent first, trg indexing the target string pool.
+    # Sources are looked up by binary search in their sorted pool.
+    def __init__(self, dic):
+        # dic: src -> {trg: count} with targets in order of first appearance
+        srcs = sorted(dic)
+        trgs = sorted(set(t for i in dic.values() for t in i))
+        trg_id = {t: n for n, t in enumerate(trgs)}
+        self.srcs = StringPool(srcs)
+        self.trgs = StringPool(trgs)
+        del trgs
+        self.trg_start = array('i', [0])
+        self.trg = array('i')
+        self.count = array('i')
+        self.total = array('q')
+        for src in srcs:
+            # equal counts keep the order of first appearance
+            ranked = sorted(dic[src].items(), key=lambda x: x[1],
+                            reverse=True)
+            for t, c in ranked:
+                self.trg.append(trg_id[t])
+                self.count.append(c)
+            self.trg_start.append(len(self.trg))
+            self.total.append(sum(c for t, c in ranked))
+        # mentions repeat their tokens, so remember recent lookups
+        self.find = functools.lru_cache(maxsize=1 << 16)(self.srcs.find)
+
+    def __len__(self):
+        return len(self.srcs)
+
+    def __contains__(self, src):
+        return self.find(src) >= 0
+
+    def __getitem__(self, src):
+        res = self.ranked(src)
+        if res is None:
+            raise KeyError(src)
+        return res
+
+    def ranked(self, src, k=None):
+        # [(trg, count)] of src, most frequent first, at most k; None if
+        # src is not in the dict
+        n = self.find(src)
+        if n < 0:
+            return None
+        beg = self.trg_start[n]
+        end = self.trg_start[n+1]
+        if k is not None:
+            end = min(end, beg + k)
+        return [(self.trgs[self.trg[i]], self.count[i])
+                for i in range(beg, end)]
+
+    def total_count(self, src):
+        return self.total[self.find(src)]
+
+
 def read_dic(pdic):
+    # Returns a RankedDic of src -> (trg, count) ranked by count
     RE_STRIP = r' \([^)]*\)|\<[^)]*\>|,|"|\.|\'|:|-'
-    res = defaultdict(lambda : defaultdict(int))
+    res = defaultdict(dict)
     with open(pdic, 'r') as f:
         for line in f:
             src, trg = line.rstrip('\n').split('\t')
             # trg = ' '.join(re.sub(RE_STRIP, '', trg).strip().split())
-            res[src][trg] += 1
-    for i in res:
-        res[i] = [x for x, y in sorted(res[i].items(),
-                                       key=lambda x: x[1], reverse=True)]
-    return res
-
-
-def isListEmpty(inList):
-    if isinstance(inList, list):
-        return all(map(isListEmpty, inList))
-    return False
-
-
-def partial_trans(mention, dic):
-    res = []
+            trgs = res[src]
+            trgs[trg] = trgs.get(trg, 0) + 1
+    return RankedDic(res)
+
+
+def iter_trans(trans_toks, k=1):
+    # Lazily yields up to k (score, translation) pairs in descending score
+    # order. trans_toks holds, per token, (trg, score) choices sorted by
+    # score; a candidate scores the sum of its choices. Only the frontier of
+    # the product is kept on the heap instead of the full product.
+    if k < 1 or not all(trans_toks):
+        return
+    start = (0,) * len(trans_toks)
+    heap = [(-sum(i[0][1] for i in trans_toks), start)]
+    seen = {start}
+    while heap and k:
+        score, ranks = heapq.heappop(heap)
+        yield -score, ' '.join(trans_toks[n][r][0]
+                               for n, r in enumerate(ranks))
+        k -= 1
+        for n, r in enumerate(ranks):
+            if r + 1 == len(trans_toks[n]):
+                continue
+            nxt = ranks[:n] + (r + 1,) + ranks[n+1:]
+            if nxt in seen:
+                continue
+            seen.add(nxt)
+            heapq.heappush(heap, (score + trans_toks[n][r][1] -
+                                  trans_toks[n][r+1][1], nxt))
+
+
+def partial_trans(mention, dic, k=1):
+    # Token by token translation, each token scored by the log of its
+    # translation's relative frequency. Returns the k best candidates.
     trans_toks = []
+    found = False
     for tok in mention.split(' '):
-        if tok in dic:
-            trans_toks.append([list(dic[tok])[0]])
+        ranked = dic.ranked(tok, k)
+        if ranked is not None:
+            total = dic.total_count(tok)
+            trans_toks.append([(t, math.log(c / total)) for t, c in ranked])
+            found = True
         else:
-            trans_toks.append([])
-
-    if not isListEmpty(trans_toks):
-        for n in range(len(trans_toks)):
-            if not trans_toks[n]:
-                trans_toks[n] = ['NULL']
-        for i in list(itertools.product(*trans_toks)):
-            res.append(' '.join(i))
-        return '*' + '|'.join(res)
+            trans_toks.append([('NULL', 0.0)])
+
+    if found:
+        return '*' + '|'.join(t for score, t in iter_trans(trans_toks, k))
     return None
 
 
-def main(pdic, tab, outpath=None, match='partial'):
+def main(pdic, tab, outpath=None, match='partial', topk=1):
     logger.info('loading dict...')
     dic = read_dic(pdic)
     logger.info('dict size: %s' % len(dic))
@@ -68,9 +150,9 @@ def main(pdic, tab, outpath=None, match='partial'):
         mention = tmp[2]
         trans = None
         if mention in dic:
-            trans = '|'.join(dic[mention])
+            trans = '|'.join(t for t, c in dic[mention])
         elif match != 'exact':
-            trans = partial_trans(mention, dic)
+            trans = partial_trans(mention, dic, k=topk)
             if match == 'tok_exact':
                 if trans and 'NULL' in trans:
                     trans = None
@@ -102,9 +184,11 @@ if __name__ == '__main__':
     parser.add_argument('--match', type=str,
                         help='match approach: %s' % matches,
                         default='exact')
+    parser.add_argument('--topk', type=int, default=1,
+                        help='number of partial translations per mention')
     args = parser.parse_args()
     if args.match not in matches:
         print('unrecognizeed match approach: %s' % args.match)
         exit()
     tab = open(args.ptab, 'r').read().split('\n')
-    main(args.pdic, tab, args.outpath, match=args.match)
+    main(args.pdic, tab, args.outpath, match=args.match, topk=args.topk)
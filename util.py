@@ -1,21 +1,24 @@
-import re
+from array import array
 from collections import defaultdict
 import logging
 
+from automaton import Trie, AhoCorasick
+
 
 logger = logging.getLogger()
 
 
 class TacTab(object):
+    __slots__ = ('runid', 'qid', 'mention', 'offset', 'docid', 'beg', 'end',
+                 'kbid', 'etype', 'mtype', 'conf', 'trans')
+
     def __init__(self, runid, qid, mention, offset, kbid, etype, mtype, conf,
                  trans=None):
         self.runid = runid
         self.qid = qid
         self.mention = mention
         self.offset = offset
-        self.docid = re.match('(.+):(\d+)-(\d+)', offset).group(1)
-        self.beg = int(re.match('(.+):(\d+)-(\d+)', offset).group(2))
-        self.end = int(re.match('(.+):(\d+)-(\d+)', offset).group(3))
+        self.docid, self.beg, self.end = parse_offset(offset)
         self.kbid = kbid
         self.etype = etype
         self.mtype = mtype
@@ -26,12 +29,37 @@ class TacTab(object):
         return '\t'.join([self.runid, self.qid, self.mention, self.offset,
                           self.kbid, self.etype, self.mtype, self.conf])
 
-def read_tab(ptab):
-    res = []
+    def copy(self):
+        res = TacTab.__new__(TacTab)
+        for i in TacTab.__slots__:
+            setattr(res, i, getattr(self, i))
+        return res
+
+
+def parse_offset(offset):
+    # 'docid:beg-end' -> (docid, beg, end); docid may itself contain ':'
+    docid, _, span = offset.rpartition(':')
+    beg, _, end = span.partition('-')
+    return docid, int(beg), int(end)
+
+
+def iter_tab(ptab):
     with open(ptab, 'r') as f:
         for line in f:
-            res.append(TacTab(*line.rstrip('\n').split('\t')))
-    return res
+            yield TacTab(*line.rstrip('\n').split('\t'))
+
+
+def read_tab(ptab):
+    return list(iter_tab(ptab))
+
+
+def write_tab(tab, outpath):
+    # Same file as writing '\n'.join of the lines, without building it
+    with open(outpath, 'w') as fw:
+        for n, i in enumerate(tab):
+            if n:
+                fw.write('\n')
+            fw.write(str(i))
 
 
 def read_psm(ppsm):
@@ -46,31 +74,86 @@ def read_psm(ppsm):
     return res
 
 
-def read_bio(pbio):
-    res = defaultdict(list)
-    data = re.split('\n\s*\n', open(pbio).read())
-    for i in data:
-        sent = i.split('\n')
-        for i, line in enumerate(sent):
-            if not line:
-                continue
-            ann = line.split(' ')
-            try:
-                assert len(ann) >= 2
-            except AssertionError:
-                logger.error('line is less than two columns')
-                logger.error(repr(line))
-                exit()
-            tok = ann[0]
-            offset = ann[1]
-            m = re.match('(.+):(\d+)-(\d+)', offset)
-            docid = m.group(1)
-            beg = int(m.group(2))
-            end = int(m.group(3))
-            res[docid].append((tok, beg, end))
+class BioDoc(object):
+    # Tokens of one document with their offsets packed into integer arrays.
+    # Indexes and iterates like a list of (tok, beg, end) tuples.
+    __slots__ = ('toks', 'begs', 'ends')
+
+    def __init__(self, items=()):
+        self.toks = []
+        self.begs = array('q')
+        self.ends = array('q')
+        self.extend(items)
+
+    def __len__(self):
+        return len(self.toks)
+
+    def __getitem__(self, n):
+        return self.toks[n], self.begs[n], self.ends[n]
+
+    def __iter__(self):
+        return zip(self.toks, self.begs, self.ends)
+
+    def append(self, item):
+        tok, beg, end = item
+        self.toks.append(tok)
+        self.begs.append(beg)
+        self.ends.append(end)
+
+    def extend(self, items):
+        for i in items:
+            self.append(i)
+
+
+def parse_bio(lines, compact=False):
+    # Yields (docid, tokens) per document of BIO lines. A document split
+    # into several non-adjacent blocks is yielded once per block.
+    new_doc = BioDoc if compact else list
+    docid = None
+    doc = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        ann = line.split(' ')
+        try:
+            assert len(ann) >= 2
+        except AssertionError:
+            logger.error('line is less than two columns')
+            logger.error(repr(line))
+            exit()
+        tok = ann[0]
+        tok_docid, beg, end = parse_offset(ann[1])
+        if tok_docid != docid:
+            if doc is not None:
+                yield docid, doc
+            docid = tok_docid
+            doc = new_doc()
+        doc.append((tok, beg, end))
+    if doc is not None:
+        yield docid, doc
+
+
+def iter_bio(pbio, compact=False):
+    # Yields (docid, tokens) per document as the file is read
+    with open(pbio, 'r', buffering=1 << 20) as f:
+        yield from parse_bio(f, compact=compact)
+
+
+def read_bio(pbio, compact=False):
+    res = defaultdict(BioDoc if compact else list)
+    for docid, doc in iter_bio(pbio, compact=compact):
+        res[docid].extend(doc)
     return res
 
 
+def iter_docs(bio):
+    # Accept both a read_bio dict and an iter_bio stream
+    if isinstance(bio, dict):
+        return bio.items()
+    return bio
+
+
 def get_tab_in_doc_level(tab):
     res = defaultdict(list)
     for i in tab:
@@ -78,10 +161,53 @@ def get_tab_in_doc_level(tab):
     return res
 
 
+def fold(s):
+    # Lookup key of a string in lowercase mode
+    return s.lower()
+
+
+class Vocab(object):
+    # Folded keys of the BIO tokens and tab mentions of a lowercase mode
+    # run. Each distinct string is folded once, and equal keys share one
+    # string object, so the lookups into resources keyed on fold() compare
+    # by identity. Forgets everything past max_size strings, which only
+    # costs refolding.
+    def __init__(self, max_size=1 << 20):
+        self.max_size = max_size
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def key(self, s):
+        res = self._keys.get(s)
+        if res is None:
+            if len(self._keys) >= self.max_size:
+                self._keys.clear()
+            res = fold(s)
+            res = self._keys.setdefault(res, res)
+            self._keys[s] = res
+        return res
+
+    def keys(self, toks):
+        key = self.key
+        return [key(tok) for tok in toks]
+
+
+def new_vocab(lower):
+    # Vocab of a run, None outside lowercase mode where keys are the
+    # strings themselves
+    return Vocab() if lower else None
+
+
 def read_gaz(pgaz, lower=False):
+    res = read_gaz_entries(pgaz, lower=lower)
+    return res, build_gaz_trie(res)
+
+
+def read_gaz_entries(pgaz, lower=False):
     ETYPES = ['PER', 'ORG', 'GPE', 'LOC', 'FAC', '-', 'WEA', 'VEH', 'SID']
     res = {}
-    res_tree = {}
     with open(pgaz, 'r') as f:
         for line in f:
             if not line.rstrip() or line.startswith('//'):
@@ -89,7 +215,7 @@ def read_gaz(pgaz, lower=False):
             tmp = line.rstrip('\n').split('\t')
             mention = tmp[0]
             if lower:
-                mention = mention.lower()
+                mention = fold(mention)
             etype = tmp[1]
             op = tmp[2]
             if len(tmp) > 3:
@@ -111,14 +237,27 @@ def read_gaz(pgaz, lower=False):
                     logger.warn(msg)
 
             res[mention] = (etype, op, additional_info)
+    return res
 
-            toks = mention.split(' ') # TO-DO: no space langs
-            tree = res_tree
-            for tok in toks:
-                if tok not in tree:
-                    tree[tok] = {}
-                tree = tree[tok]
-    return res, res_tree
+
+def build_gaz_trie(gaz):
+    res = Trie()
+    for mention in gaz:
+        toks = mention.split(' ') # no space langs: build_gaz_chars()
+        res.add(toks, mention)
+    return res
+
+
+def build_gaz_chars(gaz):
+    # Character automaton of a gazetteer for languages written without
+    # spaces. Entries are matched on their characters with spaces left out,
+    # so they match however the BIO tokenized them.
+    res = AhoCorasick()
+    for mention in gaz:
+        chars = mention.replace(' ', '')
+        if chars:
+            res.add(chars, (mention, len(chars)))
+    return res.build()
 
 
 def read_rule(prule, lower=False):
@@ -132,7 +271,7 @@ def read_rule(prule, lower=False):
             tmp = line.rstrip('\n').split('\t')
             mention = tmp[0]
             if lower:
-                mention = mention.lower()
+                mention = fold(mention)
             etype = tmp[1]
             try:
                 assert etype in ETYPES
@@ -145,3 +284,23 @@ def read_rule(prule, lower=False):
                 assert operate[1][0] in ETYPES
             res[mention][etype] = operate
     return res
+
+
+def compile_rule(rule):
+    # Flatten the rule table into a hash index over (mention, etype) for
+    # the exact pass, and compile every pattern that can fire as an in_rm
+    # rule into one substring automaton. A pattern's value is None when it
+    # applies to ALL types, otherwise the set of types it applies to.
+    exact = {}
+    in_rm = AhoCorasick()
+    for mention, ops in rule.items():
+        for etype, op in ops.items():
+            exact[(mention, etype)] = op
+        if 'ALL' in ops:
+            if ops['ALL'][0] == 'in_rm':
+                in_rm.add(mention, None)
+        else:
+            etypes = set(e for e, op in ops.items() if op[0] == 'in_rm')
+            if etypes:
+                in_rm.add(mention, etypes)
+    return exact, in_rm.build()